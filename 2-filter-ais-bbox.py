@@ -1,15 +1,18 @@
 """
 Geographic filtering for AIS data files.
 This script filters AIS CSV files to only include records within a specified bounding box.
+With --cache-dir, results are cached per month and bbox: an exact repeat is served from the cache,
+and a bbox contained in a cached one is filtered from the smaller cached output instead of the raw month.
 """
 
 import argparse
 import time
 import os
 import aisdb
-from util import filter_by_bbox
+from util import filter_by_bbox, file_signature, link_or_copy, FilterCache
 
-def process_month_files(year: int, month: int, bbox: tuple, base_dir: str, output_dir: str) -> tuple:
+def process_month_files(year: int, month: int, bbox: tuple, base_dir: str, output_dir: str,
+                        cache: FilterCache = None) -> tuple:
     """
     Filter a month's worth of AIS data files by geographic bounding box.
     
@@ -19,6 +22,7 @@ def process_month_files(year: int, month: int, bbox: tuple, base_dir: str, outpu
         bbox: Bounding box as (min_lon, min_lat, max_lon, max_lat)
         base_dir: Base directory containing source files
         output_dir: Directory for filtered output files
+        cache: Optional filter result cache; if None every month is filtered from the raw files
         
     Returns:
         tuple: (List of filtered files, Processing time)
@@ -36,13 +40,36 @@ def process_month_files(year: int, month: int, bbox: tuple, base_dir: str, outpu
     month_output_dir = f"{output_dir}/{year}{month:02d}"
     os.makedirs(month_output_dir, exist_ok=True)
     
-    # Filter the files
-    filtered_files = filter_by_bbox(
-        file_paths=filepaths,
-        bbox=bbox,
-        output_dir=month_output_dir,
-        prefix=""  # No prefix needed since files are in their own directory
-    )
+    if cache is None:
+        # Filter the files
+        filtered_files = filter_by_bbox(
+            file_paths=filepaths,
+            bbox=bbox,
+            output_dir=month_output_dir,
+            prefix=""  # No prefix needed since files are in their own directory
+        )
+    else:
+        month_key = f"{year}{month:02d}"
+        sources = [file_signature(f) for f in filepaths]
+        entry, exact = cache.lookup(month_key, bbox, sources)
+
+        if exact:
+            print(f"Cache hit for {month_key}: bbox already filtered")
+            cached_outputs = entry['outputs']
+        else:
+            # Narrow from the smallest cached superset when there is one
+            input_files = entry['outputs'] if entry is not None else filepaths
+            if entry is not None:
+                print(f"Filtering {month_key} from cached bbox {tuple(entry['bbox'])}")
+            cached_outputs = filter_by_bbox(
+                file_paths=input_files,
+                bbox=bbox,
+                output_dir=cache.entry_dir(month_key, bbox, sources),
+                prefix=""
+            )
+            cache.add(month_key, bbox, sources, cached_outputs)
+
+        filtered_files = link_or_copy(cached_outputs, month_output_dir)
     
     elapsed_time = time.time() - start_time
     print(f"Filtered {year}{month:02d}: {len(filtered_files)}/{len(filepaths)} files contain data in bounding box")
@@ -62,6 +89,8 @@ def main():
     parser.add_argument('--min-lat', type=float, default=36.02, help='Minimum latitude')
     parser.add_argument('--max-lon', type=float, default=-57.62, help='Maximum longitude')
     parser.add_argument('--max-lat', type=float, default=48.64, help='Maximum latitude')
+    parser.add_argument('--cache-dir', type=str, default=None, help='Directory for cached filter results (default: no cache, always filter from the raw files)')
+    parser.add_argument('--cache-quota-gb', type=float, default=200, help='Disk quota for cached filter results in GB')
     
     args = parser.parse_args()
     
@@ -70,6 +99,8 @@ def main():
     
     # Create the output directory
     os.makedirs(args.output_dir, exist_ok=True)
+
+    cache = None if args.cache_dir is None else FilterCache(args.cache_dir, int(args.cache_quota_gb * 1024 ** 3))
     
     # Save a record of the bounding box used
     with open(f"{args.output_dir}/bbox_info.txt", 'w') as f:
@@ -91,7 +122,8 @@ def main():
                 month=month,
                 bbox=bbox,
                 base_dir=args.base_dir,
-                output_dir=args.output_dir
+                output_dir=args.output_dir,
+                cache=cache
             )
             all_filtered_files.extend(filtered_files)
     
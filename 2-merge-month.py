@@ -0,0 +1,148 @@
+"""
+Monthly merge of daily AIS files.
+This script streams the daily CSV files of each month into one file per month, ordered by
+(MMSI, BaseDateTime), so downstream stages reading merged/ get vessel-contiguous input.
+Each day is sorted in memory and spilled as a sorted run, then the runs are combined with a
+heap-based k-way merge, optionally dropping exact duplicate rows on the way.
+"""
+
+import argparse
+import heapq
+import shutil
+import tempfile
+import time
+import os
+from concurrent.futures import ProcessPoolExecutor
+import aisdb
+
+
+def _key_indices(header: bytes) -> tuple:
+    columns = header.decode(errors='replace').strip().split(',')
+    return columns.index('MMSI'), columns.index('BaseDateTime')
+
+
+def _row_key(line: bytes, mmsi_idx: int, time_idx: int, maxsplit: int) -> tuple:
+    # MMSI and BaseDateTime come before any quoted free-text column in the NOAA layout
+    fields = line.split(b',', maxsplit)
+    return int(fields[mmsi_idx]), fields[time_idx]
+
+
+def sort_day(file_path: str, run_path: str) -> tuple:
+    """
+    Sort one daily file by (MMSI, BaseDateTime) in memory and write it as a run without header.
+
+    Returns:
+        tuple: (header, rows written, rows skipped)
+    """
+    with open(file_path, 'rb') as f:
+        header = next(f)
+        mmsi_idx, time_idx = _key_indices(header)
+        maxsplit = max(mmsi_idx, time_idx) + 1
+
+        keyed = []
+        skipped = 0
+        for line in f:
+            try:
+                keyed.append((_row_key(line, mmsi_idx, time_idx, maxsplit), line if line.endswith(b'\n') else line + b'\n'))
+            except (ValueError, IndexError):
+                skipped += 1
+
+    keyed.sort(key=lambda item: item[0])
+    with open(run_path, 'wb') as out:
+        out.writelines(line for _, line in keyed)
+    return header, len(keyed), skipped
+
+
+def merge_runs(run_paths: list, header: bytes, output_path: str, dedup: bool = False) -> tuple:
+    """
+    K-way merge sorted runs into output_path.
+    With dedup, byte-identical rows sharing an (MMSI, BaseDateTime) key are written once; only
+    the rows of the current key are remembered, so memory stays bounded.
+
+    Returns:
+        tuple: (rows written, duplicates dropped)
+    """
+    mmsi_idx, time_idx = _key_indices(header)
+    maxsplit = max(mmsi_idx, time_idx) + 1
+    files = [open(p, 'rb') for p in run_paths]
+    written = dropped = 0
+    try:
+        streams = [((_row_key(line, mmsi_idx, time_idx, maxsplit), line) for line in f) for f in files]
+        with open(output_path, 'wb') as out:
+            out.write(header)
+            current_key, current_rows = None, set()
+            for key, line in heapq.merge(*streams, key=lambda item: item[0]):
+                if dedup:
+                    if key != current_key:
+                        current_key, current_rows = key, set()
+                    if line in current_rows:
+                        dropped += 1
+                        continue
+                    current_rows.add(line)
+                out.write(line)
+                written += 1
+    finally:
+        for f in files:
+            f.close()
+    return written, dropped
+
+
+def merge_month(year: int, month: int, base_dir: str, output_dir: str, workers: int, dedup: bool) -> str:
+    """
+    Merge all daily files of one month into {output_dir}/{year}{month}.csv.
+
+    Returns:
+        str: Path of the merged file, or None if the month has no files.
+    """
+    month_key = f"{year}{month:02d}"
+    filepaths = aisdb.glob_files(f"{base_dir}/{month_key}", '.csv')
+    filepaths = sorted([f for f in filepaths if month_key in f])
+    print(f"Found {len(filepaths)} files for {month_key}")
+    if not filepaths:
+        return None
+
+    os.makedirs(output_dir, exist_ok=True)
+    output_path = os.path.join(output_dir, f"{month_key}.csv")
+    run_dir = tempfile.mkdtemp(prefix=f'merge_{month_key}_', dir=output_dir)
+    try:
+        run_paths = [os.path.join(run_dir, f'run_{i:03d}.csv') for i in range(len(filepaths))]
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(sort_day, filepaths, run_paths))
+
+        headers = {header for header, _, _ in results}
+        if len(headers) > 1:
+            raise ValueError(f"Daily files of {month_key} have different headers: {sorted(headers)}")
+        skipped = sum(s for _, _, s in results)
+
+        written, dropped = merge_runs(run_paths, results[0][0], output_path, dedup)
+        print(f"Merged {month_key}: {written} rows written, {dropped} duplicates dropped, {skipped} unparsable rows skipped")
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+    return output_path
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Merge daily AIS files into monthly files sorted by MMSI and time')
+    parser.add_argument('--start-year', type=int, default=2023, help='Start year')
+    parser.add_argument('--end-year', type=int, default=2023, help='End year')
+    parser.add_argument('--start-month', type=int, default=1, help='Start month')
+    parser.add_argument('--end-month', type=int, default=2, help='End month')
+    parser.add_argument('--base-dir', type=str, default='/slow-array/NOAA-unzip', help='Base directory for source files')
+    parser.add_argument('--output-dir', type=str, default='merged/', help='Output directory for merged monthly files')
+    parser.add_argument('--workers', type=int, default=4, help='Number of days sorted in parallel')
+    parser.add_argument('--dedup', action='store_true', help='Drop exact duplicate rows during the merge')
+
+    args = parser.parse_args()
+
+    total_start_time = time.time()
+    for year in range(args.start_year, args.end_year + 1):
+        for month in range(args.start_month, args.end_month + 1):
+            month_start_time = time.time()
+            merge_month(year, month, args.base_dir, args.output_dir, args.workers, args.dedup)
+            print(f"Time taken for {year}{month:02d}: {time.time() - month_start_time:.2f} seconds")
+
+    print(f"Total time: {time.time() - total_start_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
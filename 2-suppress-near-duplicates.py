@@ -0,0 +1,178 @@
+"""
+Near-duplicate and jitter suppression for AIS data files.
+This script drops bursts of reports from the same MMSI that are close in both time and position,
+so the database loaders and the trajectory simplification receive fewer redundant rows.
+"""
+
+import argparse
+import time
+import os
+import numpy as np
+import pandas as pd
+import aisdb
+
+EARTH_RADIUS_M = 6371008.8
+
+
+def haversine_m(lon1, lat1, lon2, lat2):
+    """Great-circle distance in metres between arrays of points."""
+    lon1, lat1, lon2, lat2 = map(np.radians, (lon1, lat1, lon2, lat2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+def near_duplicate_mask(mmsi: np.ndarray, t: np.ndarray, lon: np.ndarray, lat: np.ndarray,
+                        max_dt: float, max_dist: float) -> np.ndarray:
+    """
+    Flag near-duplicate reports in arrays already sorted by (MMSI, time).
+
+    Consecutive reports of one vessel within max_dt seconds and max_dist metres of each other form
+    a burst. The first report of a burst is its anchor, and later reports are dropped only while they
+    stay within both thresholds of the anchor, so slow drift through a burst is not lost. The first
+    report outside them is kept and becomes the next anchor, so a long burst keeps one report per
+    max_dt seconds or max_dist metres.
+
+    Each anchor depends on the one before it, but only through one pointer: for every row, the row
+    that would follow it as anchor is the first later row of its burst outside both thresholds.
+    Those pointers are found with one vectorised pass per row offset (only as many offsets as a
+    burst has rows within max_dt and max_dist of one row), and the kept rows are the pointer
+    chains from the burst starts, followed by pointer doubling in O(log n) vectorised steps.
+
+    >>> t = np.array([0, 0, 1, 1, 2, 2, 3, 3])
+    >>> near_duplicate_mask(np.zeros(8), t, np.zeros(8), np.zeros(8), max_dt=1, max_dist=10).astype(int)
+    array([1, 0, 0, 0, 1, 0, 0, 0])
+
+    Returns:
+        numpy.array: Boolean mask, True for rows to keep.
+    """
+    n = len(mmsi)
+    if n < 2:
+        return np.ones(n, dtype=bool)
+
+    near_prev = np.zeros(n, dtype=bool)
+    near_prev[1:] = (
+        (mmsi[1:] == mmsi[:-1]) &
+        (t[1:] - t[:-1] <= max_dt) &
+        (haversine_m(lon[:-1], lat[:-1], lon[1:], lat[1:]) <= max_dist)
+    )
+
+    # Next anchor after each row, were it an anchor; n stands for "after the last row"
+    starts = np.flatnonzero(~near_prev)
+    burst_end = np.append(starts, n)[np.searchsorted(starts, np.arange(n), side='right')]
+    following = np.full(n + 1, n)
+    pending = np.arange(n)
+    offset = 1
+    while len(pending):
+        candidate = pending + offset
+        probe = np.minimum(candidate, n - 1)
+        outside = (
+            (candidate >= burst_end[pending]) |
+            (t[probe] - t[pending] > max_dt) |
+            (haversine_m(lon[pending], lat[pending], lon[probe], lat[probe]) > max_dist)
+        )
+        following[pending[outside]] = candidate[outside]
+        pending = pending[~outside]
+        offset += 1
+
+    # Rows on the anchor chains of the burst starts: after k steps `keep` holds the first 2**k
+    # anchors of every chain and `jump` points 2**k anchors ahead
+    keep = np.zeros(n + 1, dtype=bool)
+    keep[starts] = True
+    jump = following
+    while (jump[:n] < n).any():
+        keep[jump[keep]] = True
+        jump = jump[jump]
+    return keep[:n]
+
+
+def suppress_file(file_path: str, output_path: str, max_dt: float, max_dist: float) -> pd.DataFrame:
+    """
+    Sort one AIS CSV file by (MMSI, BaseDateTime), drop near-duplicates and write the result.
+    Rows whose MMSI, time or position cannot be parsed are written through unchanged after the
+    checked rows.
+
+    Returns:
+        pandas.DataFrame: Per-vessel counts with columns MMSI, total, dropped.
+    """
+    df = pd.read_csv(file_path, on_bad_lines='skip', encoding_errors='replace', low_memory=False)
+
+    t = pd.to_datetime(df['BaseDateTime'], errors='coerce')
+    mmsi = pd.to_numeric(df['MMSI'], errors='coerce')
+    lon = pd.to_numeric(df['LON'], errors='coerce')
+    lat = pd.to_numeric(df['LAT'], errors='coerce')
+    valid = (t.notna() & mmsi.notna() & lon.notna() & lat.notna()).to_numpy()
+    rows = np.flatnonzero(valid)
+
+    t = t[valid].astype('datetime64[s]').to_numpy().astype(np.int64)
+    mmsi = mmsi[valid].to_numpy().astype(np.int64)
+    order = np.lexsort((t, mmsi))
+    mmsi, t = mmsi[order], t[order]
+    lon = lon[valid].to_numpy(dtype=np.float64)[order]
+    lat = lat[valid].to_numpy(dtype=np.float64)[order]
+
+    keep = near_duplicate_mask(mmsi, t, lon, lat, max_dt, max_dist)
+    df.iloc[np.concatenate((rows[order[keep]], np.flatnonzero(~valid)))].to_csv(output_path, index=False)
+
+    counts = pd.DataFrame({'MMSI': mmsi, 'dropped': ~keep})
+    return counts.groupby('MMSI')['dropped'].agg(total='size', dropped='sum').reset_index()
+
+
+def process_month_files(year: int, month: int, base_dir: str, output_dir: str, max_dt: float, max_dist: float) -> tuple:
+    """
+    Suppress near-duplicates in every file of a month and write a per-vessel drop report.
+
+    Returns:
+        tuple: (Rows read, Rows dropped)
+    """
+    month_dir = f"{base_dir}/{year}{month:02d}"
+    filepaths = aisdb.glob_files(month_dir, '.csv')
+    filepaths = sorted([f for f in filepaths if f'{year}{month:02d}' in f])
+    print(f"Found {len(filepaths)} files for {year}{month:02d}")
+
+    month_output_dir = f"{output_dir}/{year}{month:02d}"
+    os.makedirs(month_output_dir, exist_ok=True)
+
+    reports = []
+    for file_path in filepaths:
+        output_path = os.path.join(month_output_dir, os.path.basename(file_path))
+        try:
+            counts = suppress_file(file_path, output_path, max_dt, max_dist)
+        except Exception as e:
+            print(f"Error processing {file_path}: {e}")
+            continue
+        print(f"{file_path}: dropped {counts['dropped'].sum()}/{counts['total'].sum()} rows")
+        reports.append(counts)
+
+    if not reports:
+        return 0, 0
+    report = pd.concat(reports).groupby('MMSI', as_index=False).sum()
+    report = report.sort_values('dropped', ascending=False)
+    report.to_csv(f"{output_dir}/near_duplicate_drops_{year}{month:02d}.csv", index=False)
+    return int(report['total'].sum()), int(report['dropped'].sum())
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Drop near-duplicate AIS reports per vessel')
+    parser.add_argument('--start-year', type=int, default=2023, help='Start year')
+    parser.add_argument('--end-year', type=int, default=2023, help='End year')
+    parser.add_argument('--start-month', type=int, default=1, help='Start month')
+    parser.add_argument('--end-month', type=int, default=2, help='End month')
+    parser.add_argument('--base-dir', type=str, default='/slow-array/NOAA-filtered', help='Base directory for source files')
+    parser.add_argument('--output-dir', type=str, default='/slow-array/NOAA-thinned', help='Output directory for thinned files')
+    parser.add_argument('--max-dt', type=float, default=1.0, help='Maximum time gap in seconds for a near-duplicate')
+    parser.add_argument('--max-dist', type=float, default=10.0, help='Maximum distance in metres for a near-duplicate')
+
+    args = parser.parse_args()
+
+    total_start_time = time.time()
+    for year in range(args.start_year, args.end_year + 1):
+        for month in range(args.start_month, args.end_month + 1):
+            month_start_time = time.time()
+            rows, dropped = process_month_files(year, month, args.base_dir, args.output_dir, args.max_dt, args.max_dist)
+            print(f"{year}{month:02d}: dropped {dropped}/{rows} rows in {time.time() - month_start_time:.2f} seconds")
+
+    print(f"Total time: {time.time() - total_start_time:.2f} seconds")
+
+
+if __name__ == "__main__":
+    main()
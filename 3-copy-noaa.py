@@ -0,0 +1,131 @@
+"""
+Native bulk loader for NOAA CSV files into the AISdb schema.
+NOAA files are already decoded, so instead of going through aisdb.decode_msgs this script maps
+the NOAA columns straight onto the AISdb dynamic and static tables. PostgreSQL is loaded with
+several parallel COPY streams (binary format by default); SQLite with executemany batches in one
+large transaction per file.
+"""
+
+import argparse
+import time
+import aisdb
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from util import load_noaa_file_postgres, load_noaa_file_sqlite, create_month_tables_postgres, LoadLedger
+
+# psql connection string
+USER = 'ruixin'
+PASSWORD = 'ruixin123'
+ADDRESS = '127.0.0.1'
+PORT = 5432
+DBNAME = 'noaa'
+psql_conn_string = f"postgresql://{USER}:{PASSWORD}@{ADDRESS}:{PORT}/{DBNAME}"
+
+
+def load_file(file_path: str, backend: str, target: str, binary: bool, sort: bool) -> tuple:
+    """Load one file and return (file_path, rows, seconds, error)."""
+    start_time = time.time()
+    try:
+        if backend == 'postgres':
+            rows = load_noaa_file_postgres(target, file_path, binary=binary, sort=sort)
+        else:
+            rows = load_noaa_file_sqlite(target, file_path, sort=sort)
+    except Exception as e:
+        return file_path, 0, time.time() - start_time, str(e)
+    return file_path, rows, time.time() - start_time, None
+
+
+def aggregate_static(backend: str, target: str, month: str):
+    """Build static_{month}_aggregate, which the aisdb query paths join against, from the loaded static table."""
+    if backend == 'postgres':
+        with aisdb.PostgresDBConn(libpq_connstring=target) as dbconn:
+            dbconn.aggregate_static_msgs([month])
+    else:
+        with aisdb.SQLiteDBConn(dbpath=target) as dbconn:
+            dbconn.aggregate_static_msgs([month])
+
+
+def month_process(year: int, month: int, base_dir: str, backend: str, target: str, streams: int, binary: bool,
+                  sort: bool = True) -> list:
+    """
+    Load one month of CSV files, with up to `streams` files loading concurrently.
+    SQLite allows a single writer, so it always loads one file at a time. Files already
+    recorded as loaded in the ledger are skipped. PostgreSQL month tables are created once up
+    front, so the concurrent file transactions never race to create them. Once the files are
+    loaded, the month's static_{month}_aggregate table is rebuilt with aisdb, as decode_msgs does.
+
+    Returns:
+        list: Files that failed to load.
+    """
+    print(f'Loading {year}{month:02d}')
+
+    filepaths = aisdb.glob_files(f'{base_dir}/{year}{month:02d}', '.csv')
+    filepaths = sorted([f for f in filepaths if f'{year}{month:02d}' in f])
+
+    ledger = LoadLedger.postgres(target) if backend == 'postgres' else LoadLedger.sqlite(target)
+    pending = ledger.pending(filepaths)
+
+    print(f'Number of files: {len(filepaths)}, pending: {len(pending)}')
+
+    failed = []
+    total_rows = 0
+    month_start_time = time.time()
+    if backend == 'sqlite':
+        streams = 1
+    elif pending:
+        create_month_tables_postgres(target, [f'{year}{month:02d}'])
+
+    with ProcessPoolExecutor(max_workers=streams) as executor:
+        futures = []
+        for f in pending:
+            ledger.start(f)
+            futures.append(executor.submit(load_file, f, backend, target, binary, sort))
+        for future in as_completed(futures):
+            file_path, rows, elapsed, error = future.result()
+            if error is not None:
+                print(f'Error loading {file_path}: {error}')
+                ledger.fail(file_path, error)
+                failed.append(file_path)
+                continue
+            ledger.done(file_path, rows)
+            total_rows += rows
+            print(f'Loaded {file_path}: {rows} rows in {elapsed:.2f} seconds ({rows / max(elapsed, 1e-9):.0f} rows/s)')
+
+    ledger.close()
+    if pending:
+        aggregate_static(backend, target, f'{year}{month:02d}')
+    elapsed = time.time() - month_start_time
+    print(f'Time taken for {year}{month:02d}: {elapsed:.2f} seconds, {total_rows / max(elapsed, 1e-9):.0f} rows/s')
+    return failed
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Bulk load NOAA CSV files into AISdb tables')
+    parser.add_argument('--backend', choices=['postgres', 'sqlite'], default='postgres', help='Target database type')
+    parser.add_argument('--dbpath', type=str, default='./marine_cadastre.db', help='SQLite database path')
+    parser.add_argument('--start-year', type=int, default=2023, help='Start year')
+    parser.add_argument('--end-year', type=int, default=2023, help='End year')
+    parser.add_argument('--start-month', type=int, default=1, help='Start month')
+    parser.add_argument('--end-month', type=int, default=2, help='End month')
+    parser.add_argument('--base-dir', type=str, default='/slow-array/NOAA-unzip', help='Base directory for source files')
+    parser.add_argument('--streams', type=int, default=8, help='Parallel COPY streams for PostgreSQL')
+    parser.add_argument('--text', action='store_true', help='Use text COPY instead of binary COPY')
+    parser.add_argument('--no-sort', action='store_true', help='Insert rows in file order instead of (MMSI, time) order')
+    args = parser.parse_args()
+
+    target = psql_conn_string if args.backend == 'postgres' else args.dbpath
+
+    failed = []
+    overall_start_time = time.time()
+    for year in range(args.start_year, args.end_year + 1):
+        for month in range(args.start_month, args.end_month + 1):
+            failed += month_process(year, month, args.base_dir, args.backend, target, args.streams, not args.text,
+                                    not args.no_sort)
+
+    print(f'Total execution time: {time.time() - overall_start_time:.2f} seconds')
+    if failed:
+        print(f'\nThe following files failed to load: {failed}')
+    print('Processing complete.')
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,47 @@
 import os
+import re
+import csv
+import zlib
+import heapq
+import shutil
+import argparse
+import tempfile
 from glob import glob
+from itertools import islice, groupby
 from concurrent.futures import ProcessPoolExecutor
-def remove_duplicates_python(file_path):
+from functools import partial
+from util import HashDedup
+
+TIMESTAMP_PATTERN = re.compile(r'^\d{4}-\d{2}-\d{2}T')
+
+
+def remove_duplicates_python(file_path, verify=True, batch_size=1000000):
     """
     Remove duplicate rows from a CSV file, keeping the header.
-    This function reads the file line by line to handle large files efficiently.
+    Rows are streamed in batches and reduced to fingerprints held in a HashDedup table,
+    so memory grows by roughly 20-27 bytes per distinct row (with verify) rather than a copy of every line.
     """
-    seen = set()
     temp_file_path = file_path + ".tmp"
+    seen = HashDedup(capacity=os.path.getsize(file_path) // 100, verify=verify)
 
     try:
-        with open(file_path, 'r') as infile:
-            with open(temp_file_path, 'w') as outfile:
+        with open(file_path, 'rb') as infile:
+            with open(temp_file_path, 'wb') as outfile:
                 header = next(infile)
                 outfile.write(header)
-                seen.add(header.strip())
+                seen.add(*HashDedup.fingerprint([header.strip()]))
 
-                for line in infile:
-                    if line.strip() not in seen:
-                        outfile.write(line)
-                        seen.add(line.strip())
+                while True:
+                    lines = list(islice(infile, batch_size))
+                    if not lines:
+                        break
+                    is_new = seen.add(*HashDedup.fingerprint([line.strip() for line in lines]))
+                    outfile.writelines(line for line, new in zip(lines, is_new) if new)
 
         # Ensure the temporary file is not empty before replacing the original file
         if os.path.getsize(temp_file_path) > 0:
             os.replace(temp_file_path, file_path)
-            print(f"Processed and updated {file_path}")
+            print(f"Processed and updated {file_path} ({seen.count} unique rows, {seen.nbytes / 1024 ** 2:.0f} MiB table)")
         else:
             print(f"Temporary file {temp_file_path} is empty. Original file not replaced.")
             os.remove(temp_file_path)
@@ -33,11 +50,144 @@ def remove_duplicates_python(file_path):
         print(f"Error processing {file_path}: {e}")
         if os.path.exists(temp_file_path):
             os.remove(temp_file_path)
+        raise
+
+
+def normalize_key_value(value):
+    """
+    Normalise a key field so rows that differ only in formatting compare equal:
+    numbers are compared by value and ISO timestamps by their space-separated form.
+    """
+    value = value.strip()
+    try:
+        return repr(float(value))
+    except ValueError:
+        pass
+    if TIMESTAMP_PATTERN.match(value):
+        return value.replace('T', ' ', 1)
+    return value
+
+
+def _pick(candidates, policy):
+    """Choose the surviving row among (seq, completeness, row) tuples sharing one key."""
+    if policy == 'complete':
+        return min(candidates, key=lambda c: (-c[1], c[0]))
+    return min(candidates, key=lambda c: c[0])
+
+
+def _write_run(buffer, scratch_dir, run_index):
+    """Sort a buffer of (key, seq, completeness, row) by key and original order and spill it to CSV."""
+    buffer.sort(key=lambda item: (item[0], item[1]))
+    run_path = os.path.join(scratch_dir, f'run_{run_index}.csv')
+    with open(run_path, 'w', newline='') as f:
+        writer = csv.writer(f)
+        for key, seq, completeness, row in buffer:
+            writer.writerow(list(key) + [seq, completeness] + row)
+    return run_path
+
+
+def remove_duplicates_by_key(file_path, key_columns, policy='first', max_bytes_in_memory=64 * 1024 ** 2,
+                             scratch_dir=None):
+    """
+    Remove rows that agree on the key columns, even if other fields differ.
 
+    Rows are deduplicated in memory while their text fits in `max_bytes_in_memory`; held as
+    Python lists of strings they take roughly ten times that. Larger files switch to an external
+    sort: sorted runs are spilled to a scratch directory and merged with a heap, so memory stays
+    bounded; in that case the output is ordered by key instead of file order. Rows whose field
+    count does not match the header are written through unchanged after the deduplicated rows.
 
-def process_files_in_parallel(directory):
+    Args:
+        file_path (str): CSV file to deduplicate in place.
+        key_columns (list): Column names that identify a record, e.g. MMSI, BaseDateTime, LAT, LON.
+        policy (str): 'first' keeps the first occurrence, 'complete' keeps the row with the most
+            non-empty fields (ties go to the first occurrence).
+        max_bytes_in_memory (int): Budget of buffered row text before spilling sorted runs to disk.
+        scratch_dir (str): Directory for spill files; defaults to the directory of the file.
+    """
+    temp_file_path = file_path + ".tmp"
+    run_dir = tempfile.mkdtemp(prefix='dedup_', dir=scratch_dir or os.path.dirname(os.path.abspath(file_path)))
+    malformed_path = os.path.join(run_dir, 'malformed.csv')
+    runs = []
+    kept = 0
+    malformed = 0
+
+    try:
+        with open(file_path, 'r', newline='', errors='replace') as infile, \
+                open(malformed_path, 'w', newline='') as malformed_file:
+            reader = csv.reader(infile)
+            malformed_writer = csv.writer(malformed_file, lineterminator='\n')
+            header = next(reader)
+            key_idx = [header.index(c) for c in key_columns]
+
+            buffer = []
+            buffered_bytes = 0
+            for seq, row in enumerate(reader):
+                if len(row) != len(header):
+                    malformed_writer.writerow(row)
+                    malformed += 1
+                    continue
+                key = tuple(normalize_key_value(row[i]) for i in key_idx)
+                buffer.append((key, seq, sum(1 for v in row if v.strip()), row))
+                buffered_bytes += sum(map(len, row)) + len(row)
+                if buffered_bytes >= max_bytes_in_memory:
+                    runs.append(_write_run(buffer, run_dir, len(runs)))
+                    buffer = []
+                    buffered_bytes = 0
+
+        with open(temp_file_path, 'w', newline='') as outfile:
+            writer = csv.writer(outfile, lineterminator='\n')
+            writer.writerow(header)
+
+            if not runs:
+                best = {}
+                for key, seq, completeness, row in buffer:
+                    best[key] = _pick([best[key], (seq, completeness, row)], policy) if key in best else (seq, completeness, row)
+                for _, _, row in sorted(best.values(), key=lambda c: c[0]):
+                    writer.writerow(row)
+                    kept += 1
+            else:
+                if buffer:
+                    runs.append(_write_run(buffer, run_dir, len(runs)))
+                    buffer = []
+                n_keys = len(key_idx)
+                files = [open(r, 'r', newline='') for r in runs]
+                try:
+                    merged = heapq.merge(*[csv.reader(f) for f in files],
+                                         key=lambda r: (r[:n_keys], int(r[n_keys])))
+                    for _, group in groupby(merged, key=lambda r: r[:n_keys]):
+                        candidates = [(int(r[n_keys]), int(r[n_keys + 1]), r[n_keys + 2:]) for r in group]
+                        writer.writerow(_pick(candidates, policy)[2])
+                        kept += 1
+                finally:
+                    for f in files:
+                        f.close()
+
+            # Rows that could not be keyed are kept as they were
+            with open(malformed_path, 'r', newline='') as f:
+                shutil.copyfileobj(f, outfile)
+
+        os.replace(temp_file_path, file_path)
+        mode = f'external sort, {len(runs)} runs' if runs else 'in memory'
+        print(f"Processed and updated {file_path} by key {key_columns} ({kept} rows kept, {mode})")
+        if malformed:
+            print(f"{file_path}: {malformed} rows with a wrong field count were written through unchanged")
+
+    except Exception as e:
+        print(f"Error processing {file_path}: {e}")
+        if os.path.exists(temp_file_path):
+            os.remove(temp_file_path)
+        raise
+    finally:
+        shutil.rmtree(run_dir, ignore_errors=True)
+
+
+def process_files_in_parallel(directory, max_workers=8, verify=True, key_columns=None, policy='first',
+                              max_bytes_in_memory=64 * 1024 ** 2):
     """
     Process CSV files in the specified directory in parallel, removing duplicates.
+    Without key_columns rows must be byte-identical to be duplicates; with key_columns rows are
+    compared on those columns only.
     """
     if not os.path.exists(directory):
         print(f"Directory '{directory}' does not exist.")
@@ -49,12 +199,142 @@ def process_files_in_parallel(directory):
         print(f"No CSV files found in directory '{directory}'.")
         return
 
-    max_workers = 2  # Adjust based on system capacity
-
     with ProcessPoolExecutor(max_workers=max_workers) as executor:
-        executor.map(remove_duplicates_python, csv_files)
+        if key_columns:
+            n = len(csv_files)
+            executor.map(remove_duplicates_by_key, csv_files, [key_columns] * n, [policy] * n,
+                         [max_bytes_in_memory] * n)
+        else:
+            executor.map(remove_duplicates_python, csv_files, [verify] * len(csv_files))
+
+
+def scatter_file(file_path, bucket_dir, n_buckets, file_index):
+    """
+    Phase one of the partitioned dedup: append each row of a file to the bucket chosen by a
+    CRC32 hash of its normalised MMSI (see normalize_key_value), so every copy of a record lands
+    in the same bucket whichever daily file or zone archive it came from, even when one writes
+    the MMSI as 367000001 and another as 367000001.0. MMSI must precede any quoted free-text column, as in
+    the NOAA layout where it is the first column. Rows too short to have an MMSI go to the
+    `malformed` directory and are written through unchanged.
+
+    Returns:
+        tuple: (header line of the file, number of malformed rows)
+    """
+    outputs = [open(os.path.join(bucket_dir, f'bucket_{b:04d}', f'part_{file_index:05d}.csv'), 'wb')
+               for b in range(n_buckets)]
+    outputs.append(open(os.path.join(bucket_dir, 'malformed', f'part_{file_index:05d}.csv'), 'wb'))
+    malformed = 0
+    try:
+        with open(file_path, 'rb') as infile:
+            header = next(infile)
+            mmsi_idx = header.decode(errors='replace').strip().split(',').index('MMSI')
+            for line in infile:
+                fields = line.split(b',', mmsi_idx + 1)
+                if not line.endswith(b'\n'):
+                    line += b'\n'
+                if len(fields) <= mmsi_idx:
+                    outputs[-1].write(line)
+                    malformed += 1
+                    continue
+                mmsi = normalize_key_value(fields[mmsi_idx].decode(errors='replace')).encode()
+                outputs[zlib.crc32(mmsi) % n_buckets].write(line)
+    finally:
+        for f in outputs:
+            f.close()
+    return header, malformed
+
+
+def dedup_bucket(bucket_path, header, key_columns=None, policy='first', verify=True,
+                 max_bytes_in_memory=64 * 1024 ** 2):
+    """
+    Phase two of the partitioned dedup: join the parts of one bucket and deduplicate them.
+
+    Returns:
+        str: Path of the deduplicated bucket file.
+    """
+    bucket_file = bucket_path + '.csv'
+    with open(bucket_file, 'wb') as out:
+        out.write(header)
+        for part in sorted(glob(os.path.join(bucket_path, '*.csv'))):
+            with open(part, 'rb') as f:
+                shutil.copyfileobj(f, out)
+            os.remove(part)
+
+    if key_columns:
+        remove_duplicates_by_key(bucket_file, key_columns, policy, max_bytes_in_memory)
+    else:
+        remove_duplicates_python(bucket_file, verify)
+    return bucket_file
+
+
+def dedup_files_partitioned(csv_files, output_path, n_buckets=64, max_workers=8, verify=True,
+                            key_columns=None, policy='first', max_bytes_in_memory=64 * 1024 ** 2, scratch_dir=None):
+    """
+    Deduplicate a set of CSV files as one dataset, e.g. all daily files of a month.
+
+    Rows are scattered into MMSI-hash buckets in parallel, then each bucket is deduplicated
+    independently on the process pool, so duplicates spanning files are removed while memory is
+    bounded by the size of one bucket. The deduplicated buckets are concatenated into output_path,
+    followed by the rows too short to have an MMSI. If any bucket fails, the run fails and
+    output_path is not written.
+    """
+    bucket_dir = tempfile.mkdtemp(prefix='dedup_buckets_', dir=scratch_dir or os.path.dirname(os.path.abspath(output_path)))
+    try:
+        for b in range(n_buckets):
+            os.makedirs(os.path.join(bucket_dir, f'bucket_{b:04d}'))
+        os.makedirs(os.path.join(bucket_dir, 'malformed'))
+
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            scattered = list(executor.map(scatter_file, csv_files, [bucket_dir] * len(csv_files),
+                                          [n_buckets] * len(csv_files), range(len(csv_files))))
+            headers = [header for header, _ in scattered]
+            malformed = sum(count for _, count in scattered)
+            if len(set(headers)) > 1:
+                raise ValueError(f"Input files have different headers: {sorted(set(headers))}")
+            print(f"Scattered {len(csv_files)} files into {n_buckets} buckets")
+
+            dedup = partial(dedup_bucket, header=headers[0], key_columns=key_columns, policy=policy,
+                            verify=verify, max_bytes_in_memory=max_bytes_in_memory)
+            bucket_files = list(executor.map(dedup, [os.path.join(bucket_dir, f'bucket_{b:04d}') for b in range(n_buckets)]))
+
+        with open(output_path, 'wb') as out:
+            out.write(headers[0])
+            for bucket_file in bucket_files:
+                with open(bucket_file, 'rb') as f:
+                    next(f)
+                    shutil.copyfileobj(f, out)
+            for part in sorted(glob(os.path.join(bucket_dir, 'malformed', '*.csv'))):
+                with open(part, 'rb') as f:
+                    shutil.copyfileobj(f, out)
+        print(f"Deduplicated {len(csv_files)} files into {output_path}")
+        if malformed:
+            print(f"{malformed} rows too short to have an MMSI were written through unchanged")
+    finally:
+        shutil.rmtree(bucket_dir, ignore_errors=True)
 
 
 if __name__ == "__main__":
-    directory = 'merged/'
-    process_files_in_parallel(directory)
+    parser = argparse.ArgumentParser(description='Remove duplicate rows from merged AIS CSV files')
+    parser.add_argument('--directory', type=str, default='merged/', help='Directory containing the CSV files')
+    parser.add_argument('--workers', type=int, default=8, help='Number of files processed in parallel')
+    parser.add_argument('--no-verify', action='store_true', help='Use 64-bit fingerprints without the second collision-check hash')
+    parser.add_argument('--keys', type=str, default=None, help='Comma-separated key columns, e.g. MMSI,BaseDateTime,LAT,LON')
+    parser.add_argument('--policy', choices=['first', 'complete'], default='first', help='Row kept per key')
+    parser.add_argument('--max-mb-in-memory', type=float, default=64, help='MB of row text held in memory per worker before spilling sorted runs (about 10x that in Python objects)')
+    parser.add_argument('--output', type=str, default=None, help='Deduplicate all files in the directory together into this file')
+    parser.add_argument('--buckets', type=int, default=64, help='Number of MMSI-hash buckets used with --output')
+    args = parser.parse_args()
+
+    key_columns = args.keys.split(',') if args.keys else None
+    if args.output:
+        # An earlier --output written into the same directory is not an input
+        csv_files = sorted(f for f in glob(os.path.join(args.directory, "*.csv"))
+                           if os.path.abspath(f) != os.path.abspath(args.output))
+        dedup_files_partitioned(csv_files, args.output,
+                                n_buckets=args.buckets, max_workers=args.workers, verify=not args.no_verify,
+                                key_columns=key_columns, policy=args.policy,
+                                max_bytes_in_memory=int(args.max_mb_in_memory * 1024 ** 2))
+    else:
+        process_files_in_parallel(args.directory, max_workers=args.workers, verify=not args.no_verify,
+                                  key_columns=key_columns, policy=args.policy,
+                                  max_bytes_in_memory=int(args.max_mb_in_memory * 1024 ** 2))
@@ -1,8 +1,14 @@
 import aisdb
+import psycopg
 import time
-import shutil
-import glob
-import os
+import argparse
+from contextlib import nullcontext
+from multiprocessing import Manager
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from util import LoadLedger, ScratchSpace, use_tempdir, load_noaa_file_postgres, partition_attached, \
+    create_partition_parent, create_load_partition, attach_load_partition, drop_load_partition, \
+    create_month_tables_postgres, flush_deferred_rows
 
 # psql connection string
 USER = 'ruixin'
@@ -17,88 +23,239 @@ end_year = 2017
 start_month = 4
 end_month = 12
 
-failed_batches = set() # store the failed files and loop through them later
 
-overall_start_time = time.time()
+def month_process(year: int, month: int, workers: int = 6, writer_slots=None, scratch: ScratchSpace = None) -> bool:
+    """
+    Load the files of one month that the ledger does not record as loaded.
+    Pending files are decoded in batches of `workers` files, so every aisdb worker has a file.
+    Each batch is committed and recorded in the ledger together, so a retry or restart only
+    reloads the batches that failed or never finished. The writer slot is taken before the ledger
+    connection is opened and the files are hashed, so writer_slots caps every connection.
 
-def clean_tmp_folders():
-    """Remove all /tmp/tmp* directories before retrying."""
-    tmp_dirs = glob.glob('/tmp/tmp*')
-    for tmp_dir in tmp_dirs:
-        if os.path.isdir(tmp_dir):
-            try:
-                shutil.rmtree(tmp_dir)
-                print(f"Removed temporary directory: {tmp_dir}")
-            except Exception as e:
-                print(f"Error removing {tmp_dir}: {e}")
-
-
-def month_process(year: int, month: int) -> bool:
+    Args:
+        year: Year to load
+        month: Month to load
+        workers: Decoding workers used by aisdb for this month
+        writer_slots: Optional shared semaphore capping concurrent database writers across months
+        scratch: Optional scratch space; decoding temp files go to a directory of this month in it
+    """
     print(f'Loading {year}{month:02d}')
 
     filepaths = aisdb.glob_files(f'/slow-array/NOAA-unzip/{year}{month:02d}', '.csv')
     filepaths = sorted([f for f in filepaths if f'{year}{month:02d}' in f])
 
+    if writer_slots is not None:
+        writer_slots.acquire()
+    try:
+        try:
+            ledger = LoadLedger.postgres(psql_conn_string)
+        except Exception as e:
+            print(f'Error opening load ledger for {year}{month:02d}: {e}')
+            return False
+        try:
+            pending = ledger.pending(filepaths)
+
+            print(f'Number of files: {len(filepaths)}, pending: {len(pending)}')
+
+            month_scratch = f'{year}{month:02d}'
+            tempdir = scratch.worker_dir(month_scratch) if scratch is not None else None
+            success = True
+            for i in range(0, len(pending), workers):
+                batch = pending[i:i + workers]
+                for filepath in batch:
+                    ledger.start(filepath)
+                try:
+                    with use_tempdir(tempdir) if tempdir else nullcontext():
+                        with aisdb.PostgresDBConn(libpq_connstring=psql_conn_string) as dbconn:
+                            aisdb.decode_msgs(batch,
+                                              dbconn=dbconn,
+                                              source='noaa',
+                                              verbose=True,
+                                              skip_checksum=True,
+                                              raw_insertion=True,
+                                              workers=workers,
+                                              timescaledb=True)
+                except Exception as e:
+                    print(f'Error loading {batch}: {e}')
+                    for filepath in batch:
+                        ledger.fail(filepath, str(e))
+                    success = False
+                    continue
+                finally:
+                    if scratch is not None and scratch.over_quota():
+                        print(f'Scratch usage {scratch.bytes_used() / 1024 ** 3:.1f} GB exceeds quota')
+                        scratch.reset(month_scratch)
+                for filepath in batch:
+                    ledger.done(filepath)
+        finally:
+            ledger.close()
+    finally:
+        if writer_slots is not None:
+            writer_slots.release()
+
+    return success
+
+
+def month_process_partitioned(year: int, month: int, workers: int = 6, writer_slots=None) -> bool:
+    """
+    Load one month into a detached partition for plain (non-Timescale) PostgreSQL.
+
+    The month is bulk loaded with parallel COPY streams into a standalone table that is unlogged
+    and has no indexes. It is then indexed, analysed, set logged and attached to the range-partitioned
+    ais_dynamic table. A failed month is dropped whole without touching the parent. Crash recovery
+    empties unlogged tables, so this mode reloads whole months rather than resuming per file.
+
+    Only rows inside the month go into its partition. Rows stamped in a neighbouring month are
+    deferred and moved into that month's partition once it is attached, so no month is ever
+    created as a plain table. The static table of the month is created before the parallel
+    loads start, and the writer slot is taken before any connection is opened.
+    """
+    month_key = f'{year}{month:02d}'
+    print(f'Loading {month_key} into a detached partition')
+
+    filepaths = aisdb.glob_files(f'/slow-array/NOAA-unzip/{month_key}', '.csv')
+    filepaths = sorted([f for f in filepaths if month_key in f])
+
     print(f'Number of files: {len(filepaths)}')
 
+    if writer_slots is not None:
+        writer_slots.acquire()
     try:
-        with aisdb.PostgresDBConn(libpq_connstring=psql_conn_string) as dbconn:
-            aisdb.decode_msgs(filepaths,
-                              dbconn=dbconn,
-                              source='noaa',
-                              verbose=True,
-                              skip_checksum=True,
-                              raw_insertion=True,
-                              workers=6,
-                              timescaledb=True)
-    except Exception as e:
-        print(f'Error loading {year}{month:02d}: {e}')
-        return False
+        with psycopg.connect(psql_conn_string, autocommit=True) as conn:
+            if partition_attached(conn, month_key):
+                print(f'{month_key} is already attached, skipping')
+                return True
+
+            try:
+                create_load_partition(conn, month_key)
+                create_month_tables_postgres(psql_conn_string, [month_key], dynamic=False)
+                load = partial(load_noaa_file_postgres, psql_conn_string, month=month_key)
+                with ProcessPoolExecutor(max_workers=workers) as executor:
+                    rows = sum(executor.map(load, filepaths))
+                attach_load_partition(conn, month_key)
+                print(f'Attached {month_key} with {rows} rows')
+                # The native COPY path skips aisdb.decode_msgs, which would otherwise build the static aggregate
+                with aisdb.PostgresDBConn(libpq_connstring=psql_conn_string) as dbconn:
+                    dbconn.aggregate_static_msgs([month_key])
+            except Exception as e:
+                print(f'Error loading {month_key}: {e}')
+                drop_load_partition(conn, month_key)
+                return False
+
+            moved = flush_deferred_rows(conn)
+            if moved:
+                print(f'Moved {moved} deferred rows into attached partitions')
+    finally:
+        if writer_slots is not None:
+            writer_slots.release()
 
     return True
 
 
-for year in range(start_year, end_year + 1):
-    for month in range(start_month, end_month + 1):
-        month_start_time = time.time()
-        # should grasp all the files 
-        success = month_process(year, month)
-        if not success:
-            failed_batches.add((year, month))
+def timed_month_process(year: int, month: int, workers: int, writer_slots=None, scratch: ScratchSpace = None,
+                        partitioned: bool = False) -> tuple:
+    month_start_time = time.time()
+    if partitioned:
+        success = month_process_partitioned(year, month, workers, writer_slots)
+    else:
+        success = month_process(year, month, workers, writer_slots, scratch)
+    return year, month, success, time.time() - month_start_time
+
+
+def run_months(months: list, parallel_months: int, max_writers: int, workers: int, scratch: ScratchSpace = None,
+               partitioned: bool = False) -> set:
+    """
+    Load a list of (year, month) tuples, several at once when parallel_months > 1.
+
+    Months run on a process pool; a shared semaphore caps how many of them hold a database
+    connection at the same time, so the total connection budget is max_writers * workers.
+    With partitioned=True the shared parent tables are created once before any month starts.
+
+    Returns:
+        set: (year, month) tuples that failed to load.
+    """
+    failed = set()
+
+    if partitioned:
+        with psycopg.connect(psql_conn_string, autocommit=True) as conn:
+            create_partition_parent(conn)
+
+    if parallel_months <= 1:
+        for i, (year, month) in enumerate(months, 1):
+            year, month, success, elapsed = timed_month_process(year, month, workers, scratch=scratch, partitioned=partitioned)
+            print(f'[{i}/{len(months)}] Time taken for {year}{month:02d}: {elapsed:.2f} seconds')
+            if not success:
+                failed.add((year, month))
+        return failed
 
-        month_end_time = time.time()
-        print(f'Time taken for {year}{month:02d}: {month_end_time - month_start_time:.2f} seconds')
+    with Manager() as manager:
+        writer_slots = manager.BoundedSemaphore(max_writers)
+        with ProcessPoolExecutor(max_workers=parallel_months) as executor:
+            futures = [executor.submit(timed_month_process, year, month, workers, writer_slots, scratch, partitioned)
+                       for year, month in months]
+            for i, future in enumerate(as_completed(futures), 1):
+                year, month, success, elapsed = future.result()
+                status = 'loaded' if success else 'failed'
+                print(f'[{i}/{len(months)}] {year}{month:02d} {status} in {elapsed:.2f} seconds')
+                if not success:
+                    failed.add((year, month))
+    return failed
 
-overall_end_time = time.time()
-print(f'Total execution time for the first pass: {overall_end_time - overall_start_time:.2f} seconds')
 
-# retry loop for failed batches
-max_retries = 3
-retry_attempt = 0
+def main():
+    parser = argparse.ArgumentParser(description='Load NOAA CSV files into PostgreSQL')
+    parser.add_argument('--start-year', type=int, default=start_year, help='Start year')
+    parser.add_argument('--end-year', type=int, default=end_year, help='End year')
+    parser.add_argument('--start-month', type=int, default=start_month, help='Start month')
+    parser.add_argument('--end-month', type=int, default=end_month, help='End month')
+    parser.add_argument('--workers', type=int, default=6, help='Decoding workers per month')
+    parser.add_argument('--parallel-months', type=int, default=1, help='Months loaded at the same time')
+    parser.add_argument('--max-writers', type=int, default=None, help='Cap on months writing to the database at once (default: --parallel-months)')
+    parser.add_argument('--partitioned', action='store_true', help='Plain PostgreSQL: load each month into a detached partition of ais_dynamic')
+    parser.add_argument('--scratch-dir', type=str, default=None, help='Root for scratch files, e.g. tmpfs or local NVMe (default: $NOAA_SCRATCH_DIR or the system temp dir)')
+    parser.add_argument('--scratch-quota-gb', type=float, default=100, help='Scratch space quota in GB')
+    args = parser.parse_args()
 
-while failed_batches and retry_attempt < max_retries:
-    print(f'\nRetry attempt {retry_attempt + 1} for {len(failed_batches)} failed batches.')
+    scratch = ScratchSpace(args.scratch_dir, int(args.scratch_quota_gb * 1024 ** 3))
 
-    clean_tmp_folders() # clean up temp folders before retry
+    max_writers = args.max_writers or args.parallel_months
+    months = [(year, month)
+              for year in range(args.start_year, args.end_year + 1)
+              for month in range(args.start_month, args.end_month + 1)]
 
-    current_failures = failed_batches.copy()  # copy failed set and clean for reprocessing
-    failed_batches.clear()
+    overall_start_time = time.time()
 
-    for year, month in current_failures:
-        print(f'Retrying {year}{month:02d}')
-        success = month_process(year, month)
-        if not success:
-            failed_batches.add((year, month))
+    failed_batches = run_months(months, args.parallel_months, max_writers, args.workers, scratch, args.partitioned)  # months with failed files, retried through the ledger
+
+    overall_end_time = time.time()
+    print(f'Total execution time for the first pass: {overall_end_time - overall_start_time:.2f} seconds')
+
+    # retry loop for failed batches
+    max_retries = 3
+    retry_attempt = 0
+
+    while failed_batches and retry_attempt < max_retries:
+        print(f'\nRetry attempt {retry_attempt + 1} for {len(failed_batches)} failed batches.')
+
+        scratch.reset() # clean up this run's scratch files before retry
+
+        failed_batches = run_months(sorted(failed_batches), args.parallel_months, max_writers, args.workers, scratch,
+                                    args.partitioned)
+
+        # wait before next retry attempt
+        if failed_batches:
+            print(f'{len(failed_batches)} batches still failing after attempt {retry_attempt + 1}. Waiting before retry...')
+            time.sleep(10)  # sleep for 10 seconds
+        retry_attempt += 1
 
-    # wait before next retry attempt
     if failed_batches:
-        print(f'{len(failed_batches)} batches still failing after attempt {retry_attempt + 1}. Waiting before retry...')
-        time.sleep(10)  # sleep for 10 seconds
-    retry_attempt += 1
+        print(f'\nThe following batches failed after {max_retries} attempts: {failed_batches}')
+    else:
+        print('\nAll batches processed successfully after retries.')
+
+    scratch.cleanup()
+    print('Processing complete.')
 
-if failed_batches:
-    print(f'\nThe following batches failed after {max_retries} attempts: {failed_batches}')
-else:
-    print('\nAll batches processed successfully after retries.')
 
-print('Processing complete.')
+if __name__ == "__main__":
+    main()
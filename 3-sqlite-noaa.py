@@ -1,8 +1,8 @@
 import aisdb
 import time
-import shutil
-import glob
 import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from util import LoadLedger, ScratchSpace, use_tempdir, load_noaa_file_sqlite, merge_sqlite_shard, build_sqlite_indexes
 
 dbpath = './marine_cadastre_NE_2023_Jan_Feb.db'
 
@@ -11,51 +11,141 @@ end_year = 2023
 start_month = 1
 end_month = 2
 
-failed_batches = set() # store the failed files and loop through them later
+# scratch space for decoding spill files, ideally tmpfs or local NVMe (defaults to $NOAA_SCRATCH_DIR or the system temp dir)
+scratch_root = None
+scratch_quota_gb = 100
+scratch = ScratchSpace(scratch_root, int(scratch_quota_gb * 1024 ** 3))
 
-overall_start_time = time.time()
+# bulk-ingest mode: load each daily file into its own shard DB in parallel (no indexes, write-optimised
+# pragmas), merge the shards into dbpath in (mmsi, time) order, then build indexes and ANALYZE once
+bulk_ingest = False
+shard_workers = 6
 
-def clean_tmp_folders():
-    """Remove all /tmp/tmp* directories before retrying."""
-    tmp_dirs = glob.glob('/tmp/tmp*')
-    for tmp_dir in tmp_dirs:
-        if os.path.isdir(tmp_dir):
-            try:
-                shutil.rmtree(tmp_dir)
-                print(f"Removed temporary directory: {tmp_dir}")
-            except Exception as e:
-                print(f"Error removing {tmp_dir}: {e}")
+# aisdb decodes the files of one decode_msgs call in parallel, so pending files are passed in
+# batches of this many files (one per worker)
+decode_workers = 6
+
+failed_batches = set() # store the months with failed files and loop through them later
 
+overall_start_time = time.time()
 
 def month_process(year: int, month: int) -> bool:
+    """
+    Load the files of one month that the ledger does not record as loaded.
+    Pending files are decoded in batches of decode_workers files, so every aisdb worker has a
+    file. Each batch is committed and recorded in the ledger together, so a retry or restart only
+    reloads the batches that failed or never finished.
+    """
     print(f'Loading {year}{month:02d}')
 
     filepaths = aisdb.glob_files(f'/slow-array/NOAA-filtered/{year}{month:02d}', '.csv')
     filepaths = sorted([f for f in filepaths if f'{year}{month:02d}' in f])
 
-    print(f'Number of files: {len(filepaths)}')
+    ledger = LoadLedger.sqlite(dbpath)
+    pending = ledger.pending(filepaths)
+
+    print(f'Number of files: {len(filepaths)}, pending: {len(pending)}')
+
+    month_scratch = f'{year}{month:02d}'
+    success = True
+    with use_tempdir(scratch.worker_dir(month_scratch)):
+        for i in range(0, len(pending), decode_workers):
+            batch = pending[i:i + decode_workers]
+            for filepath in batch:
+                ledger.start(filepath)
+            try:
+                with aisdb.SQLiteDBConn(dbpath=dbpath) as dbconn:
+                    aisdb.decode_msgs(batch,
+                                      dbconn=dbconn,
+                                      source='noaa',
+                                      verbose=True,
+                                      skip_checksum=True,
+                                      raw_insertion=True,
+                                      workers=decode_workers)
+            except Exception as e:
+                print(f'Error loading {batch}: {e}')
+                for filepath in batch:
+                    ledger.fail(filepath, str(e))
+                success = False
+                continue
+            finally:
+                if scratch.over_quota():
+                    print(f'Scratch usage {scratch.bytes_used() / 1024 ** 3:.1f} GB exceeds quota')
+                    scratch.reset(month_scratch)
+            for filepath in batch:
+                ledger.done(filepath)
+
+    ledger.close()
+    return success
+
+
+def month_process_bulk(year: int, month: int) -> bool:
+    """
+    Bulk-ingest the pending files of one month through parallel shard databases.
+    Each file is written to its own shard in the scratch space, then the shards are merged into
+    dbpath one by one and recorded in the ledger after their merge commits. The native loader
+    bypasses decode_msgs, so the month's static_{month}_aggregate table is then built with aisdb.
+    """
+    print(f'Bulk loading {year}{month:02d}')
+
+    filepaths = aisdb.glob_files(f'/slow-array/NOAA-filtered/{year}{month:02d}', '.csv')
+    filepaths = sorted([f for f in filepaths if f'{year}{month:02d}' in f])
 
-    try:
+    ledger = LoadLedger.sqlite(dbpath)
+    pending = ledger.pending(filepaths)
+
+    print(f'Number of files: {len(filepaths)}, pending: {len(pending)}')
+
+    month_scratch = f'{year}{month:02d}'
+    shard_dir = scratch.worker_dir(month_scratch)
+    shards = {f: os.path.join(shard_dir, os.path.basename(f) + '.db') for f in pending}
+
+    success = True
+    loaded = []
+    with ProcessPoolExecutor(max_workers=shard_workers) as executor:
+        futures = {}
+        for filepath in pending:
+            ledger.start(filepath)
+            if os.path.exists(shards[filepath]):
+                os.remove(shards[filepath])  # shards have no keys, never append to a stale one
+            futures[executor.submit(load_noaa_file_sqlite, shards[filepath], filepath, 'noaa', 500000, True)] = filepath
+        for future in as_completed(futures):
+            filepath = futures[future]
+            try:
+                future.result()
+                loaded.append(filepath)
+            except Exception as e:
+                print(f'Error loading {filepath} into shard: {e}')
+                ledger.fail(filepath, str(e))
+                success = False
+
+    for filepath in sorted(loaded):
+        try:
+            rows = merge_sqlite_shard(dbpath, shards[filepath])
+        except Exception as e:
+            print(f'Error merging shard of {filepath}: {e}')
+            ledger.fail(filepath, str(e))
+            success = False
+            continue
+        ledger.done(filepath, rows)
+        os.remove(shards[filepath])
+
+    if loaded:
         with aisdb.SQLiteDBConn(dbpath=dbpath) as dbconn:
-            aisdb.decode_msgs(filepaths,
-                              dbconn=dbconn,
-                              source='noaa',
-                              verbose=True,
-                              skip_checksum=True,
-                              raw_insertion=True,
-                              workers=6)
-    except Exception as e:
-        print(f'Error loading {year}{month:02d}: {e}')
-        return False
+            dbconn.aggregate_static_msgs([month_scratch])
 
-    return True
+    scratch.reset(month_scratch)
+    ledger.close()
+    return success
 
 
+process = month_process_bulk if bulk_ingest else month_process
+
 for year in range(start_year, end_year + 1):
     for month in range(start_month, end_month + 1):
         month_start_time = time.time()
         # should grasp all the files 
-        success = month_process(year, month)
+        success = process(year, month)
         if not success:
             failed_batches.add((year, month))
 
@@ -72,14 +162,14 @@ retry_attempt = 0
 while failed_batches and retry_attempt < max_retries:
     print(f'\nRetry attempt {retry_attempt + 1} for {len(failed_batches)} failed batches.')
 
-    clean_tmp_folders() # clean up temp folders before retry
+    scratch.reset() # clean up this run's scratch files before retry
 
     current_failures = failed_batches.copy()  # copy failed set and clean for reprocessing
     failed_batches.clear()
 
     for year, month in current_failures:
         print(f'Retrying {year}{month:02d}')
-        success = month_process(year, month)
+        success = process(year, month)
         if not success:
             failed_batches.add((year, month))
 
@@ -94,4 +184,8 @@ if failed_batches:
 else:
     print('\nAll batches processed successfully after retries.')
 
+if bulk_ingest:
+    build_sqlite_indexes(dbpath)
+
+scratch.cleanup()
 print('Processing complete.')
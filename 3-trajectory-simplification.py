@@ -1,111 +1,211 @@
+"""
+Trajectory simplification of the merged monthly AIS files.
+Each file is read into typed numpy columns sorted by (MMSI, time), so a vessel track is a slice
+of those columns; with --partitions the rows are first scattered into MMSI-hash partitions under
+--scratch-dir and the partitions are sorted in memory on a process pool. All tracks of a file
+(or partition) are simplified in one batch call (Visvalingam-Whyatt, Douglas-Peucker or TD-TR),
+on --simplify-workers processes sharing the columns through shared memory.
+
+Every track gets SR, LLR and ASED (against the simplified track interpolated at the original
+timestamps). DTW and discrete Frechet are computed together in a banded anti-diagonal pass
+around each point's last kept point, batched over the tracks of a range; --metric-radius 0
+evaluates the exact full matrix. --evaluate sample restricts DTW and Frechet to a deterministic
+sample stratified by VesselType and log2 point count (MMSI hash below --sample-rate, at least
+--min-per-stratum per stratum), and --evaluate cheap skips them. --save-masks stores the
+keep-masks as mask_{algorithm}_{month}.npz so a later --evaluate-deferred run can write DTW and
+Frechet of all tracks to deferred_eval_{algorithm}_{month}.csv.
+"""
+
 import os
 import csv
-from tqdm import tqdm
-from collections import defaultdict
-from datetime import datetime
+import argparse
 import heapq
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+from tqdm import tqdm
 import numpy as np
-from scipy.spatial.distance import euclidean
-from fastdtw import fastdtw
-from rdp import rdp
-from similaritymeasures import frechet_dist
-from scipy.spatial import distance
+import pandas as pd
+from util import parse_noaa_time, ScratchSpace
 
 
-def read_and_group_csv_generator(file_path, chunk_size=5000000):
+# Columns of a grouped track, in output order
+TRACK_COLUMNS = ['MMSI', 'BaseDateTime', 'LAT', 'LON', 'SOG', 'COG', 'Heading', 'VesselName', 'IMO', 'CallSign',
+                 'VesselType', 'Status', 'Length', 'Width', 'Draft', 'Cargo', 'TransceiverClass']
+FLOAT_COLUMNS = ['LAT', 'LON', 'SOG', 'COG', 'Heading']
+TEXT_COLUMNS = ['VesselName', 'IMO', 'CallSign', 'VesselType', 'Status', 'Length', 'Width', 'Draft', 'Cargo',
+                'TransceiverClass']
+
+
+def _chunk_columns(chunk):
     """
-    Reads a large CSV file in chunks in a memory-efficient way, sorts by MMSI and BaseDateTime,
-    and yields rows grouped by MMSI one at a time.
+    Convert a chunk of CSV rows to typed column arrays: MMSI as int64, BaseDateTime as epoch
+    seconds (float64), kinematics as float64 and the vessel attributes as strings.
+    Rows with an unparsable MMSI or timestamp, or a non-finite LAT or LON, are dropped; the
+    simplifiers and metrics need every position to be a real point.
+    """
+    mmsi = pd.to_numeric(chunk['MMSI'], errors='coerce')
+    t = parse_noaa_time(chunk['BaseDateTime'].astype(str))
+    floats = {col: pd.to_numeric(chunk[col], errors='coerce').to_numpy(dtype=np.float64) for col in FLOAT_COLUMNS}
+    valid = (mmsi.notna() & t.notna()).to_numpy() & np.isfinite(floats['LAT']) & np.isfinite(floats['LON'])
+    if not valid.all():
+        print(f"Skipping {(~valid).sum()} rows with invalid MMSI, BaseDateTime, LAT or LON")
+
+    columns = {
+        'MMSI': mmsi.to_numpy()[valid].astype(np.int64),
+        'BaseDateTime': t.to_numpy()[valid],
+    }
+    for col in FLOAT_COLUMNS:
+        columns[col] = floats[col][valid]
+    for col in TEXT_COLUMNS:
+        columns[col] = chunk[col].fillna('').to_numpy(dtype=str)[valid]
+    return columns
+
+
+def _sort_columns(columns):
+    """
+    Stable sort typed columns by (MMSI, BaseDateTime) and locate the track boundaries.
+
+    Returns:
+        tuple: (sorted columns, offsets), where track i spans rows offsets[i]:offsets[i + 1].
+    """
+    order = np.lexsort((columns['BaseDateTime'], columns['MMSI']))
+    columns = {col: values[order] for col, values in columns.items()}
+    starts = np.flatnonzero(np.diff(columns['MMSI'])) + 1
+    offsets = np.concatenate(([0], starts, [len(order)])) if len(order) else np.zeros(1, dtype=np.int64)
+    return columns, offsets.astype(np.int64)
+
+
+def _read_chunks(file_path, chunk_size):
+    """Yield the typed columns of each chunk of a CSV file."""
+    for chunk in pd.read_csv(file_path, chunksize=chunk_size, dtype={col: str for col in TEXT_COLUMNS},
+                             on_bad_lines='skip', encoding_errors='replace'):
+        yield _chunk_columns(chunk)
+
+
+def _concat_sorted(parts):
+    if not parts:
+        return {col: np.empty(0) for col in TRACK_COLUMNS}, np.zeros(1, dtype=np.int64)
+    columns = {col: np.concatenate([part[col] for part in parts]) for col in TRACK_COLUMNS}
+    return _sort_columns(columns)
+
+
+def _load_sorted_columns(file_path, chunk_size=5000000):
+    """
+    Read a CSV file in chunks into typed numpy columns sorted by (MMSI, BaseDateTime).
+
+    Returns:
+        tuple: (columns, offsets), see _sort_columns.
+    """
+    return _concat_sorted(list(_read_chunks(file_path, chunk_size)))
+
+
+def _mmsi_hash(mmsi):
+    # Fibonacci hashing spreads sequential MMSI blocks evenly over the 64-bit range
+    return mmsi.astype(np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+
+
+def _mmsi_partition(mmsi, n_partitions):
+    return ((_mmsi_hash(mmsi) >> np.uint64(32)) % np.uint64(n_partitions)).astype(np.int64)
+
+
+def spill_partitions(file_path, scratch_dir, n_partitions=64, chunk_size=5000000):
+    """
+    Scatter the rows of a CSV file into MMSI-hash partitions on disk, so that each partition holds
+    whole tracks and can be sorted in memory on its own.
+
+    Each chunk of the file appends one record to every partition it has rows for. A record is one
+    np.save array per column, in TRACK_COLUMNS order, so nothing is re-parsed as text later.
 
     Args:
         file_path (str): Path to the CSV file.
+        scratch_dir (str): Directory for the partition files.
+        n_partitions (int): Number of partitions; choose it so that one partition fits in memory.
         chunk_size (int): Number of rows to read per chunk.
 
+    Returns:
+        list: Paths of the non-empty partition files.
+    """
+    paths = [os.path.join(scratch_dir, f'part_{i:04d}.npy') for i in range(n_partitions)]
+    written = np.zeros(n_partitions, dtype=bool)
+    files = [open(path, 'wb') for path in paths]
+    try:
+        for columns in _read_chunks(file_path, chunk_size):
+            part = _mmsi_partition(columns['MMSI'], n_partitions)
+            order = np.argsort(part, kind='stable')
+            bounds = np.searchsorted(part[order], np.arange(n_partitions + 1))
+            for i in np.flatnonzero(np.diff(bounds)):
+                rows = order[bounds[i]:bounds[i + 1]]
+                for col in TRACK_COLUMNS:
+                    np.save(files[i], columns[col][rows], allow_pickle=False)
+                written[i] = True
+    finally:
+        for f in files:
+            f.close()
+
+    for path, used in zip(paths, written):
+        if not used:
+            os.remove(path)
+    return [path for path, used in zip(paths, written) if used]
+
+
+def load_partition(path):
+    """
+    Read all records of a partition file and sort them by (MMSI, BaseDateTime).
+
+    Returns:
+        tuple: (columns, offsets), see _sort_columns.
+    """
+    parts = []
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        while f.tell() < size:
+            parts.append({col: np.load(f, allow_pickle=False) for col in TRACK_COLUMNS})
+    return _concat_sorted(parts)
+
+
+def iter_partitions(file_path, scratch_dir, n_partitions=64, workers=4, chunk_size=5000000):
+    """
+    Spill a file into MMSI-hash partitions (spill_partitions), then load and sort the partitions on
+    a process pool, at most `workers` at a time, and remove each partition file once it is read.
+
     Yields:
-        tuple: (MMSI, track), where track is a dictionary containing grouped data.
-    """
-    temp_files = []
-
-    # Read CSV file in chunks
-    with open(file_path, 'r') as csvfile:
-        reader = csv.DictReader(csvfile)
-        chunk = []
-        for row in reader:
-            try:
-                row['BaseDateTime'] = datetime.strptime(row['BaseDateTime'], '%Y-%m-%dT%H:%M:%S')
-            except ValueError as e:
-                print(f"Error parsing date: {e}, row: {row}")
-                continue
+        tuple: (columns, offsets) of each partition, see _sort_columns.
+    """
+    paths = spill_partitions(file_path, scratch_dir, n_partitions, chunk_size)
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = deque(executor.submit(load_partition, path) for path in paths[:workers])
+        next_path = len(pending)
+        while pending:
+            columns, offsets = pending.popleft().result()
+            if next_path < len(paths):
+                pending.append(executor.submit(load_partition, paths[next_path]))
+                next_path += 1
+            yield columns, offsets
+    for path in paths:
+        os.remove(path)
+
+
+def iter_tracks(columns, offsets):
+    """Yield (MMSI, track) for each track, where track maps column names to array views."""
+    for start, end in zip(offsets[:-1], offsets[1:]):
+        yield int(columns['MMSI'][start]), {col: values[start:end] for col, values in columns.items()}
 
-            chunk.append(row)
-
-            # When chunk size is reached, sort and write to temp file
-            if len(chunk) >= chunk_size:
-                chunk.sort(key=lambda x: (x['MMSI'], x['BaseDateTime']))
-                temp_file = f'temp_{len(temp_files)}.csv'
-                with open(temp_file, 'w', newline='') as temp_csv:
-                    writer = csv.DictWriter(temp_csv, fieldnames=reader.fieldnames)
-                    writer.writeheader()
-                    writer.writerows(chunk)
-                temp_files.append(temp_file)
-                chunk = []
-
-        # Process the remaining rows
-        if chunk:
-            chunk.sort(key=lambda x: (x['MMSI'], x['BaseDateTime']))
-            temp_file = f'temp_{len(temp_files)}.csv'
-            with open(temp_file, 'w', newline='') as temp_csv:
-                writer = csv.DictWriter(temp_csv, fieldnames=reader.fieldnames)
-                writer.writeheader()
-                writer.writerows(chunk)
-            temp_files.append(temp_file)
-
-    # Merge sorted temp files
-    temp_readers = [csv.DictReader(open(f, 'r')) for f in temp_files]
-    merged_data = heapq.merge(*temp_readers, key=lambda x: (x['MMSI'], datetime.strptime(x['BaseDateTime'], '%Y-%m-%d %H:%M:%S')))
-
-    # Group by MMSI and yield
-    current_mmsi = None
-    current_track = defaultdict(list)
-    for row in merged_data:
-        try:
-            mmsi = int(row['MMSI'])
-        except ValueError:
-            print(f"Skipping row due to invalid MMSI: {row['MMSI']}")
-            continue
 
-        if mmsi != current_mmsi:
-            if current_mmsi is not None:
-                yield current_mmsi, current_track  # Yield the current track
-            current_mmsi = mmsi
-            current_track = defaultdict(list)
-
-        # Append row data to the current track
-        current_track['MMSI'].append(mmsi)
-        current_track['BaseDateTime'].append(datetime.strptime(row['BaseDateTime'], "%Y-%m-%d %H:%M:%S").timestamp())  # Convert to timestamp
-        current_track['LAT'].append(float(row['LAT']))
-        current_track['LON'].append(float(row['LON']))
-        current_track['SOG'].append(float(row['SOG']))
-        current_track['COG'].append(float(row['COG']))
-        current_track['Heading'].append(float(row['Heading']))
-        current_track['VesselName'].append(row['VesselName'])
-        current_track['IMO'].append(row['IMO'])
-        current_track['CallSign'].append(row['CallSign'])
-        current_track['VesselType'].append(row['VesselType'])
-        current_track['Status'].append(row['Status'])
-        current_track['Length'].append(row['Length'])
-        current_track['Width'].append(row['Width'])
-        current_track['Draft'].append(row['Draft'])
-        current_track['Cargo'].append(row['Cargo'])
-        current_track['TransceiverClass'].append(row['TransceiverClass'])
-
-    # Yield the last track
-    if current_mmsi is not None:
-        yield current_mmsi, current_track
-
-    # Cleanup temp files
-    for temp_file in temp_files:
-        os.remove(temp_file)
+def read_and_group_csv_generator(file_path, chunk_size=5000000):
+    """
+    Reads a CSV file into typed columns, sorts them by MMSI and BaseDateTime,
+    and yields rows grouped by MMSI one at a time.
+
+    Args:
+        file_path (str): Path to the CSV file.
+        chunk_size (int): Number of rows to read per chunk.
+
+    Yields:
+        tuple: (MMSI, track), where track is a dictionary of numpy array slices of the sorted columns.
+    """
+    columns, offsets = _load_sorted_columns(file_path, chunk_size)
+    yield from iter_tracks(columns, offsets)
 
 
 def _calculate_area(p1, p2, p3):
@@ -116,42 +216,90 @@ def _calculate_area(p1, p2, p3):
     ) / 2
 
 
-def visvalingam_whyatt(points, threshold):
-        """
-        Visvalingam-Whyatt simplification for all trajectories
-        Args:
-            points (numpy.array): Latitude and longitude of AIS data point
-            threshold (float): Area threshold for point removal
-        Returns:
-            list[dict]: Simplified trajectories
-        """
-        # def vw_method(points, threshold):
-        if len(points) < 3:
-            return np.ones(len(points), dtype=bool)  # Keep all points
-        
-        areas = np.zeros(len(points))
-        for i in range(1, len(points) - 1):
-            areas[i] = _calculate_area(points[i - 1], points[i], points[i + 1])
-        
-        mask = np.ones(len(points), dtype=bool)
-        while True:
-            min_area_idx = areas[1:-1].argmin() + 1
-            if areas[min_area_idx] > threshold:
-                break
-            mask[min_area_idx] = False
-            # Update neighboring areas
-            if min_area_idx > 1:
-                areas[min_area_idx - 1] = _calculate_area(
-                    points[min_area_idx - 2], points[min_area_idx - 1], points[min_area_idx + 1]
-                ) if mask[min_area_idx - 1] else float('inf')
-            if min_area_idx < len(points) - 2:
-                areas[min_area_idx + 1] = _calculate_area(
-                    points[min_area_idx - 1], points[min_area_idx + 1], points[min_area_idx + 2]
-                ) if mask[min_area_idx + 1] else float('inf')
-            areas[min_area_idx] = float('inf')
-        
+def _triangle_areas(p1, p2, p3):
+    """Vectorised _calculate_area over arrays of points of shape (n, 2)"""
+    return np.abs(
+        (p2[:, 0] - p1[:, 0]) * (p3[:, 1] - p1[:, 1]) -
+        (p3[:, 0] - p1[:, 0]) * (p2[:, 1] - p1[:, 1])
+    ) / 2
+
+
+def _visvalingam_whyatt_linked(points, offsets, threshold):
+    """
+    Visvalingam-Whyatt over concatenated tracks sharing one set of area and prev/next arrays.
+    The first and last points of every track are pinned, so removals never link points of
+    different tracks.
+    """
+    n = len(points)
+    mask = np.ones(n, dtype=bool)
+    if n < 3:
         return mask
 
+    points = np.asarray(points, dtype=np.float64)
+    lengths = np.diff(offsets)
+    pinned = np.zeros(n, dtype=bool)
+    pinned[offsets[:-1][lengths > 0]] = True
+    pinned[offsets[1:][lengths > 0] - 1] = True
+    areas = np.full(n, np.inf)
+    areas[1:-1] = _triangle_areas(points[:-2], points[1:-1], points[2:])
+    areas[pinned] = np.inf
+    # Only areas within the threshold go on the heap; larger ones could never be popped
+    candidates = np.flatnonzero(areas <= threshold)
+    if len(candidates) == 0:
+        return mask  # areas only change after a removal, so nothing will be removed
+
+    # One small heap per track over the shared arrays: tracks are independent, and shallow heaps
+    # are much cheaper than one heap holding the candidates of every track
+    bounds = np.searchsorted(candidates, offsets)
+    candidate_areas = areas[candidates].tolist()
+    candidates = candidates.tolist()
+    areas = areas.tolist()
+    pinned = pinned.tolist()
+    keep = [True] * n
+
+    coords = points.tolist()
+    prev = list(range(-1, n - 1))
+    nxt = list(range(1, n + 1))
+    for lo, hi in zip(bounds[:-1].tolist(), bounds[1:].tolist()):
+        if lo == hi:
+            continue
+        heap = list(zip(candidate_areas[lo:hi], candidates[lo:hi]))
+        heapq.heapify(heap)
+        while heap:
+            area, i = heapq.heappop(heap)
+            if not keep[i] or area != areas[i]:
+                continue  # removed already, or superseded by a recomputed area
+            keep[i] = False
+            p, q = prev[i], nxt[i]
+            nxt[p], prev[q] = q, p
+            for j in (p, q):
+                if not pinned[j]:
+                    areas[j] = max(_calculate_area(coords[prev[j]], coords[j], coords[nxt[j]]), area)
+                    if areas[j] <= threshold:
+                        heapq.heappush(heap, (areas[j], j))
+
+    return np.array(keep, dtype=bool)
+
+
+def visvalingam_whyatt(points, threshold):
+    """
+    Visvalingam-Whyatt simplification of one trajectory in O(n log n).
+
+    Points are removed smallest effective area first until every remaining area exceeds the
+    threshold. Removed points are unlinked from prev/next index arrays, and the areas of their
+    neighbours are recomputed and pushed to a min-heap; outdated heap entries are skipped when
+    popped. A recomputed area is never smaller than that of the point just removed, so areas are
+    eliminated in non-decreasing order. The first and last points are always kept.
+
+    Args:
+        points (numpy.array): Longitude and latitude of AIS data points, shape (n, 2).
+        threshold (float): Area threshold for point removal.
+
+    Returns:
+        numpy.array: Mask indicating points to keep.
+    """
+    return _visvalingam_whyatt_linked(points, np.array([0, len(points)]), threshold)
+
 
 def douglas_peucker(points, epsilon):
     """
@@ -162,46 +310,159 @@ def douglas_peucker(points, epsilon):
         epsilon (float): Distance threshold for point removal.
 
     Returns:
-        numpy.array: Simplified points.
+        numpy.array: Mask indicating points to keep.
     """
-    mask = rdp(points, epsilon=epsilon, return_mask=True)
-    return mask
+    points = np.asarray(points, dtype=np.float64)
+    return _top_down_batch(points, None, np.array([0, len(points)]), epsilon)
 
 # Time-dependent Trajectory Reduction (TD-TR) Algorithm
 
+def _sed(points, time, start, end):
+    """
+    Synchronized Euclidean distance of the interior points of segment start..end: the distance
+    from each point to the position interpolated on the segment at the point's own time.
+    Where the segment has no duration (repeated timestamps) the start point is used.
+    """
+    duration = time[end] - time[start]
+    ratio = (time[start + 1:end] - time[start]) / duration if duration > 0 else np.zeros(end - start - 1)
+    synced = points[start] + ratio[:, None] * (points[end] - points[start])
+    offset = points[start + 1:end] - synced
+    return np.hypot(offset[:, 0], offset[:, 1])
+
+
 def td_tr(points, time, threshold):
     """
-    Time-Dependent Trajectory Reduction (TD-TR) for all trajectories.
+    Top-down Time-Ratio simplification (TD-TR): Douglas-Peucker with the synchronized Euclidean
+    distance in place of the perpendicular distance.
+
+    A segment is split at its interior point of largest SED while that distance exceeds the
+    threshold. Segments are kept on an explicit stack, and the SED of all interior points of a
+    segment is computed in one numpy expression.
 
     Args:
-        points (numpy.array): Latitude and longitude of AIS data points.
-        time (numpy.array): Corresponding time points.
+        points (numpy.array): Longitude and latitude of AIS data points, shape (n, 2).
+        time (numpy.array): Corresponding time points, sorted ascending.
         threshold (float): Distance threshold for point removal.
 
     Returns:
         numpy.array: Mask indicating points to keep.
     """
-    if len(points) < 3:
-        return np.ones(len(points), dtype=bool)  # Keep all points
+    n = len(points)
+    if n < 3:
+        return np.ones(n, dtype=bool)  # Keep all points
+
+    points = np.asarray(points, dtype=np.float64)
+    time = np.asarray(time, dtype=np.float64)
+    mask = np.zeros(n, dtype=bool)
+    mask[0] = mask[-1] = True
+    stack = [(0, n - 1)]
+    while stack:
+        start, end = stack.pop()
+        if end - start < 2:
+            continue
+        dist = _sed(points, time, start, end)
+        i = int(dist.argmax())
+        if dist[i] > threshold:
+            split = start + 1 + i
+            mask[split] = True
+            stack.append((start, split))
+            stack.append((split, end))
+
+    return mask
+
+
+# Batch simplification of many tracks stored as ragged arrays
+
+def _segment_points(starts, ends):
+    """
+    Interior point indices of every segment starts[k]..ends[k], concatenated, with the segment
+    number of each and the position of each segment's first interior point.
+    """
+    counts = ends - starts - 1
+    first = np.cumsum(counts) - counts
+    seg = np.repeat(np.arange(len(starts)), counts)
+    idx = np.arange(counts.sum()) - first[seg] + starts[seg] + 1
+    return idx, seg, first
 
-    mask = np.ones(len(points), dtype=bool)
-    for i in range(1, len(points) - 1):
-        t_s, x_s, y_s = time[i - 1], points[i - 1][0], points[i - 1][1]
-        t_e, x_e, y_e = time[i + 1], points[i + 1][0], points[i + 1][1]
-        t_i, x_i, y_i = time[i], points[i][0], points[i][1]
 
-        # Calculate synchronized position (x', y') at time t_i
-        x_prime = x_s + (x_e - x_s) * (t_i - t_s) / (t_e - t_s)
-        y_prime = y_s + (y_e - y_s) * (t_i - t_s) / (t_e - t_s)
+def _top_down_batch(points, times, offsets, tolerance):
+    """
+    Douglas-Peucker (times None) or TD-TR (times given) over all tracks at once.
 
-        # Calculate the Euclidean distance between (x_i, y_i) and (x_prime, y_prime)
-        dist = np.sqrt((x_i - x_prime) ** 2 + (y_i - y_prime) ** 2)
-        if dist < threshold:
-            mask[i] = False
+    Every round takes all open segments of all tracks, computes the distance of their interior
+    points in one vectorised pass, finds each segment's farthest point with np.maximum.reduceat
+    and splits the segments whose farthest point exceeds the tolerance. The kept points are the
+    same as when the tracks are simplified one by one.
+    """
+    n = len(points)
+    mask = np.zeros(n, dtype=bool)
+    lengths = np.diff(offsets)
+    short = lengths < 3
+    for start, end in zip(offsets[:-1][short], offsets[1:][short]):
+        mask[start:end] = True  # Keep all points
+    starts = offsets[:-1][~short]
+    ends = offsets[1:][~short] - 1
+    mask[starts] = mask[ends] = True
+
+    while len(starts):
+        idx, seg, first = _segment_points(starts, ends)
+        a, b, p = points[starts[seg]], points[ends[seg]], points[idx]
+        if times is None:
+            # Perpendicular distance to the line through the segment ends, or to the start if they coincide
+            direction = b - a
+            norm = np.hypot(direction[:, 0], direction[:, 1])
+            cross = np.abs(direction[:, 0] * (a[:, 1] - p[:, 1]) - direction[:, 1] * (a[:, 0] - p[:, 0]))
+            point_dist = np.hypot(p[:, 0] - a[:, 0], p[:, 1] - a[:, 1])
+            dist = np.where(norm > 0, cross / np.where(norm > 0, norm, 1), point_dist)
+        else:
+            # Synchronized Euclidean distance, as in _sed
+            t_start, t_end = times[starts[seg]], times[ends[seg]]
+            duration = t_end - t_start
+            ratio = np.where(duration > 0, (times[idx] - t_start) / np.where(duration > 0, duration, 1), 0)
+            synced = a + ratio[:, None] * (b - a)
+            dist = np.hypot(p[:, 0] - synced[:, 0], p[:, 1] - synced[:, 1])
+
+        seg_max = np.maximum.reduceat(dist, first)
+        at_max = np.flatnonzero(dist == seg_max[seg])
+        _, first_max = np.unique(seg[at_max], return_index=True)
+        farthest = idx[at_max[first_max]]
+
+        split = seg_max > tolerance
+        farthest = farthest[split]
+        mask[farthest] = True
+        starts = np.concatenate((starts[split], farthest))
+        ends = np.concatenate((farthest, ends[split]))
+        open_ = ends - starts >= 2
+        starts, ends = starts[open_], ends[open_]
 
     return mask
 
 
+def simplify_tracks(points, times, offsets, algorithm, tolerance):
+    """
+    Simplify many tracks at once.
+
+    Args:
+        points (numpy.array): Longitude and latitude of all tracks concatenated, shape (n, 2).
+        times (numpy.array): Time of every point, sorted ascending within each track.
+        offsets (numpy.array): Track i spans points offsets[i]:offsets[i + 1].
+        algorithm (str): One of 'vw', 'rdp', 'tdtr'.
+        tolerance (float): Area threshold for vw, distance threshold for rdp and tdtr.
+
+    Returns:
+        numpy.array: Global mask indicating points to keep.
+    """
+    points = np.asarray(points, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    if algorithm == 'vw':
+        return _visvalingam_whyatt_linked(points, offsets, tolerance)
+    if algorithm == 'rdp':
+        return _top_down_batch(points, None, offsets, tolerance)
+    if algorithm == 'tdtr':
+        return _top_down_batch(points, np.asarray(times, dtype=np.float64), offsets, tolerance)
+    raise ValueError(f"Unknown simplification algorithm: {algorithm}")
+
+
 def eval_simplification(track_origin, track_simple):
     """
     Evaluating trajectory simplification results by Simplification Rate (SR), Length Loss Rate (LLS),
@@ -218,7 +479,153 @@ def eval_simplification(track_origin, track_simple):
     # Convert tracks to numpy arrays for easier manipulation
     origin_points = np.column_stack((track_origin['BaseDateTime'], track_origin['LON'], track_origin['LAT']))
     simple_points = np.column_stack((track_simple['BaseDateTime'], track_simple['LON'], track_simple['LAT']))
+    metrics = simplification_metrics(origin_points, simple_points)
+
+    # Basic information of the original track
+    return {
+        'SR': metrics['SR'],
+        'LLR': metrics['LLR'],
+        'DTW': metrics['DTW'],
+        'Frechet': metrics['Frechet'],
+        'ASED': metrics['ASED'],
+        'mmsi': track_origin['MMSI'][0],
+        'length_origin': metrics['length_origin'],
+        'point_origin': metrics['point_origin'],
+        'ship_type': track_origin['VesselType'][0],
+    }
+
+
+# Numeric metrics of simplification_metrics, in the order stored by simplify_and_evaluate
+METRIC_NAMES = ['SR', 'LLR', 'DTW', 'Frechet', 'ASED', 'length_origin', 'point_origin']
+
+
+# Half-width, in points of the simplified track, of the band searched by DTW and Frechet
+DEFAULT_METRIC_RADIUS = 10
+
 
+def _banded_dp(a, a_offsets, b, b_offsets, radius=None, center=None):
+    """
+    DTW (sum of matched distances) and discrete Frechet distance (largest matched distance) between
+    each pair of point sequences a[a_offsets[t]:a_offsets[t + 1]] and b[b_offsets[t]:b_offsets[t + 1]],
+    computed together along anti-diagonals of the cost matrices.
+
+    Only cells within `radius` columns of a monotone center path are evaluated (a Sakoe-Chiba
+    band), so the cost is O((n + m) * radius) per pair and the results are upper bounds of the
+    exact values; radius None evaluates the full matrices. The longer sequence of a pair is put on
+    the rows. The center path maps each row i to a column center[i], given per point of a and
+    counted from the pair's first point of b, by default the scaled diagonal. Every step advances
+    all pairs by one anti-diagonal, so the Python loop runs once per anti-diagonal of the longest
+    pair rather than once per anti-diagonal of every pair, and only three anti-diagonals are kept.
+
+    Returns:
+        tuple: (DTW, Frechet) arrays with one value per pair, NaN where a sequence is empty.
+    """
+    a_offsets, b_offsets = np.asarray(a_offsets, dtype=np.int64), np.asarray(b_offsets, dtype=np.int64)
+    dtw_out, frechet_out = np.full(len(a_offsets) - 1, np.nan), np.full(len(a_offsets) - 1, np.nan)
+    n_a, n_b = np.diff(a_offsets), np.diff(b_offsets)
+    pairs = np.flatnonzero((n_a > 0) & (n_b > 0))
+    if len(pairs) == 0:
+        return dtw_out, frechet_out
+
+    # Rows and columns of each pair as ragged index ranges into the concatenation of a and b
+    swap = n_a[pairs] < n_b[pairs]
+    points = np.concatenate((a, b))
+    a_start, b_start = a_offsets[pairs], len(a) + b_offsets[pairs]
+    n, m = np.where(swap, n_b[pairs], n_a[pairs]), np.where(swap, n_a[pairs], n_b[pairs])
+    first_row, first_col = np.where(swap, b_start, a_start), np.where(swap, a_start, b_start)
+    row_idx, row_pair, row_start = _segment_points(first_row - 1, first_row + n)
+    col_idx, _, col_start = _segment_points(first_col - 1, first_col + m)
+    i = np.arange(len(row_idx)) - row_start[row_pair]
+    row_center = np.rint(i * ((m - 1) / np.maximum(n - 1, 1))[row_pair]).astype(np.int64)
+    if center is not None:
+        given = ~swap[row_pair]
+        row_center[given] = np.asarray(center)[row_idx[given]]
+    band = m if radius is None else np.full(len(pairs), max(int(radius), 1))
+
+    # Anti-diagonal k of a pair meets the band on rows with k - band <= i + center[i] <= k + band,
+    # one range as i + center[i] increases strictly. Shifting each pair's values past the previous
+    # pair's queries keeps them in one sorted array, so all ranges come from two searchsorted calls.
+    n_diag = n + m - 1
+    span = n_diag + 2 * band.max() + 2
+    shift = np.cumsum(span) - span
+    diag_of_row = i + row_center + shift[row_pair]
+    ks, k_pair, k_start = _segment_points(np.full(len(pairs), -1), n_diag)
+    lows = np.maximum(np.maximum(ks - m[k_pair] + 1, 0),
+                      np.searchsorted(diag_of_row, ks - band[k_pair] + shift[k_pair], 'left') - row_start[k_pair])
+    highs = np.minimum(np.minimum(ks, n[k_pair] - 1),
+                       np.searchsorted(diag_of_row, ks + band[k_pair] + shift[k_pair], 'right') - 1 - row_start[k_pair])
+    highs = np.maximum(highs, lows - 1)
+
+    # Pairs are visited longest first, so those with an anti-diagonal k form a prefix of that order
+    by_length = np.argsort(-n_diag, kind='stable')
+    running = np.searchsorted(-n_diag[by_length], -np.arange(n_diag.max() + 1), 'left')
+
+    row_lon, row_lat = points[row_idx, 0], points[row_idx, 1]
+    col_lon, col_lat = points[col_idx, 0], points[col_idx, 1]
+    # Three anti-diagonal buffers per metric; pair p owns slots row_start[p] + p .. + n[p], indexed by
+    # row + 1, and its slot 0 stays inf as the out-of-matrix neighbour
+    size = len(row_idx) + len(pairs)
+    dtw = [np.full(size, np.inf) for _ in range(3)]
+    frechet = [np.full(size, np.inf) for _ in range(3)]
+    written = [np.zeros(0, dtype=np.int64)] * 3
+    for k in range(int(n_diag.max())):
+        slot = k % 3
+        cur_d, prev1_d, prev2_d = dtw[slot], dtw[(k - 1) % 3], dtw[(k - 2) % 3]
+        cur_f, prev1_f, prev2_f = frechet[slot], frechet[(k - 1) % 3], frechet[(k - 2) % 3]
+        cur_d[written[slot]] = np.inf
+        cur_f[written[slot]] = np.inf
+
+        active = by_length[:running[k]]
+        at = k_start[active] + k
+        cells, cell_pair, _ = _segment_points(lows[at] - 1, highs[at] + 1)
+        pair = active[cell_pair]
+        rows = row_start[pair] + cells
+        cols = col_start[pair] + k - cells
+        dist = np.hypot(row_lon[rows] - col_lon[cols], row_lat[rows] - col_lat[cols])
+        cell_slot = rows + pair + 1
+        written[slot] = cell_slot
+        if k == 0:
+            cur_d[cell_slot] = cur_f[cell_slot] = dist
+        else:
+            # Predecessors (i - 1, j) and (i, j - 1) lie on anti-diagonal k - 1, (i - 1, j - 1) on k - 2
+            cur_d[cell_slot] = np.minimum(np.minimum(prev1_d[cell_slot - 1], prev1_d[cell_slot]), prev2_d[cell_slot - 1]) + dist
+            cur_f[cell_slot] = np.maximum(np.minimum(np.minimum(prev1_f[cell_slot - 1], prev1_f[cell_slot]), prev2_f[cell_slot - 1]), dist)
+
+        done = by_length[running[k + 1]:running[k]]
+        last = row_start[done] + done + n[done]
+        dtw_out[pairs[done]], frechet_out[pairs[done]] = cur_d[last], cur_f[last]
+    return dtw_out, frechet_out
+
+
+def _mask_distances(points, offsets, keep, radius=DEFAULT_METRIC_RADIUS):
+    """
+    DTW and Frechet between every track of ragged points (offsets starting at 0) and its kept
+    points, with each band centred on the matching of every point to its last kept point.
+
+    Returns:
+        tuple: (DTW, Frechet) arrays with one value per track.
+    """
+    kept = np.concatenate(([0], np.cumsum(keep)))
+    kept_offsets = kept[offsets]
+    center = kept[1:] - 1 - np.repeat(kept_offsets[:-1], np.diff(offsets))
+    return _banded_dp(points, offsets, points[keep], kept_offsets, radius, center)
+
+
+def simplification_metrics(origin_points, simple_points, keep=None, radius=DEFAULT_METRIC_RADIUS, expensive=True):
+    """
+    Numeric part of eval_simplification.
+
+    Args:
+        origin_points (numpy.array): Original track as rows of (time, lon, lat).
+        simple_points (numpy.array): Simplified track as rows of (time, lon, lat).
+        keep (numpy.array): Optional keep-mask that produced simple_points from origin_points. It
+            centres the DTW and Frechet band on the matching of each point to its last kept point.
+        radius (int): Band radius for DTW and Frechet, None for the exact full-matrix values.
+        expensive (bool): Compute DTW and Frechet; when False they are NaN.
+
+    Returns:
+        dict: Values for each name in METRIC_NAMES.
+    """
     # Simplification Rate (SR)
     SR = (len(origin_points) - len(simple_points)) / len(origin_points)
 
@@ -230,38 +637,20 @@ def eval_simplification(track_origin, track_simple):
     length_simple = calculate_length(simple_points)
     LLR = (length_origin - length_simple) / length_origin   # smaller is better
 
-    # Dynamic Time Warping (DTW)
-    DTW, _ = fastdtw(origin_points[:, 1:], simple_points[:, 1:], dist=euclidean)
+    center = np.cumsum(keep) - 1 if keep is not None else None
 
-    # Frechet Distance
-    Frechet = frechet_dist(origin_points[:, 1:], simple_points[:, 1:])
-    
-    # Average Synchronized Euclidean Distance (ASED)
-    def calculate_ased(origin_points, simple_points):
-        ASED = 0
-        for i in range(1, len(origin_points) - 1):
-            t_s, x_s, y_s = origin_points[i - 1]
-            t_e, x_e, y_e = origin_points[i + 1]
-            t_i, x_i, y_i = origin_points[i]
-            
-            # Calculate synchronized position (x', y') at time t_i
-            t_s = float(t_s)
-            t_e = float(t_e)
-            t_i = float(t_i)
-            x_prime = x_s + (x_e - x_s) * (t_i - t_s) / (t_e - t_s)
-            y_prime = y_s + (y_e - y_s) * (t_i - t_s) / (t_e - t_s)
-            
-            # Calculate the Euclidean distance between (x_i, y_i) and (x_prime, y_prime)
-            ASED += np.sqrt((x_i - x_prime) ** 2 + (y_i - y_prime) ** 2)
-        
-        return ASED / len(origin_points)
-    
-    ASED = calculate_ased(origin_points, simple_points)
+    # Dynamic Time Warping (DTW) and Frechet Distance, in one banded pass
+    DTW, Frechet = np.nan, np.nan
+    if expensive:
+        dtw, frechet = _banded_dp(origin_points[:, 1:], [0, len(origin_points)],
+                                  simple_points[:, 1:], [0, len(simple_points)], radius, center)
+        DTW, Frechet = float(dtw[0]), float(frechet[0])
 
-    # Basic information of the original track
-    mmsi = track_origin['MMSI'][0]
-    num_points = len(track_origin['BaseDateTime'])
-    vessel_type = track_origin['VesselType'][0]
+    # Average Synchronized Euclidean Distance (ASED): distance from each original point to the
+    # simplified track interpolated at the same time
+    synced_lon = np.interp(origin_points[:, 0], simple_points[:, 0], simple_points[:, 1])
+    synced_lat = np.interp(origin_points[:, 0], simple_points[:, 0], simple_points[:, 2])
+    ASED = np.mean(np.hypot(origin_points[:, 1] - synced_lon, origin_points[:, 2] - synced_lat))
 
     return {
         'SR': SR,
@@ -269,23 +658,14 @@ def eval_simplification(track_origin, track_simple):
         'DTW': DTW,
         'Frechet': Frechet,
         'ASED': ASED,
-        'mmsi': mmsi,
         'length_origin': length_origin,
-        'point_origin': num_points,
-        'ship_type': vessel_type,
+        'point_origin': len(origin_points),
     }
-    # return {
-    #     'SR': SR,
-    #     'LLR': LLR,
-    #     'DTW': DTW,
-    #     'Frechet': Frechet,
-    #     'ASED': ASED,
-    # }
 
 
 def write_and_save_dict(compressed_track, save_path, first_write):
     """
-    Write a single dictionary (compressed track) to a CSV file.
+    Write a dictionary of equal-length columns (one or many compressed tracks) to a CSV file.
 
     Args:
         compressed_track (dict): The compressed trajectory data.
@@ -293,15 +673,7 @@ def write_and_save_dict(compressed_track, save_path, first_write):
         first_write (bool): Whether this is the first write (for header inclusion).
     """
     mode = 'a' if not first_write else 'w'  # Append after the first write
-    with open(save_path, mode=mode, newline='') as file:
-        writer = csv.DictWriter(file, fieldnames=compressed_track.keys())
-        if first_write:
-            writer.writeheader()  # Write header only for the first write
-
-        # Write rows
-        rows = zip(*[compressed_track[key] for key in compressed_track.keys()])
-        for row in rows:
-            writer.writerow(dict(zip(compressed_track.keys(), row)))
+    pd.DataFrame(compressed_track).to_csv(save_path, mode=mode, header=first_write, index=False)
 
 
 def write_and_save_eval_metrics(metric_dict, save_path, first_write):
@@ -321,16 +693,222 @@ def write_and_save_eval_metrics(metric_dict, save_path, first_write):
         writer.writerow(metric_dict)
 
 
-if __name__ == "__main__":
-    input_folder = './merged/'
-    # input_folder = './zip/'
-    csv_files = [f for f in os.listdir(input_folder) if f.endswith('.csv')]
-
-    # output_folder = './compressed_vw/'
-    # output_folder = './compressed_rdp/'
-    # output_folder = './compressed_tdtr/'
-    output_folder = './compressed/month/'
-    simp_algorithm = 'vw' # one of 'vw', 'rdp', 'tdtr'
+# Shared-memory arrays of the current pool, attached once per worker process
+_SHARED = {}
+_SHARED_ARRAYS = ['LON', 'LAT', 'BaseDateTime', 'offsets', 'expensive', 'mask', 'metrics']
+
+
+def _share_array(array):
+    """Copy an array into a new shared memory block; returns (block, spec to attach it)."""
+    block = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, array.dtype, buffer=block.buf)[...] = array
+    return block, (block.name, array.shape, array.dtype.str)
+
+
+def _attach_shared(specs):
+    for name, (block_name, shape, dtype) in specs.items():
+        block = shared_memory.SharedMemory(name=block_name)
+        _SHARED[name] = (block, np.ndarray(shape, dtype, buffer=block.buf))
+
+
+def _simplify_range(lon, lat, time, offsets, expensive, mask, metrics, lo, hi, algorithm, tolerance, radius):
+    """
+    Simplify and evaluate tracks lo..hi-1, writing into the mask and metrics arrays. DTW and
+    Frechet are only computed for tracks flagged in `expensive`, all of them in one batched pass.
+    """
+    start, end = offsets[lo], offsets[hi]
+    points = np.column_stack((lon[start:end], lat[start:end]))
+    mask[start:end] = simplify_tracks(points, time[start:end], offsets[lo:hi + 1] - start, algorithm, tolerance)
+    for k in range(lo, hi):
+        a, b = offsets[k], offsets[k + 1]
+        origin_points = np.column_stack((time[a:b], lon[a:b], lat[a:b]))
+        keep = mask[a:b]
+        result = simplification_metrics(origin_points, origin_points[keep], expensive=False)
+        metrics[k] = [result[name] for name in METRIC_NAMES]
+
+    flagged = lo + np.flatnonzero(expensive[lo:hi])
+    if len(flagged):
+        rows, _, first = _segment_points(offsets[flagged] - 1, offsets[flagged + 1])
+        distances = _mask_distances(np.column_stack((lon[rows], lat[rows])), np.append(first, len(rows)),
+                                    mask[rows], radius)
+        metrics[flagged, METRIC_NAMES.index('DTW')], metrics[flagged, METRIC_NAMES.index('Frechet')] = distances
+
+
+def _simplify_shared_range(lo, hi, algorithm, tolerance, radius):
+    _simplify_range(*(_SHARED[name][1] for name in _SHARED_ARRAYS), lo, hi, algorithm, tolerance, radius)
+    return hi - lo
+
+
+def _track_ranges(offsets, n_ranges):
+    """Split the tracks into up to n_ranges contiguous (lo, hi) ranges of similar point counts."""
+    targets = np.linspace(0, offsets[-1], n_ranges + 1)
+    bounds = np.unique(np.concatenate(([0], np.searchsorted(offsets, targets[1:-1]), [len(offsets) - 1])))
+    return list(zip(bounds[:-1].tolist(), bounds[1:].tolist()))
+
+
+def simplify_and_evaluate(columns, offsets, algorithm, tolerance, workers=1, radius=DEFAULT_METRIC_RADIUS,
+                          expensive=None):
+    """
+    Simplify and evaluate every track of a set of sorted columns.
+
+    SR, LLR and ASED are computed for every track; DTW and Frechet only for the tracks flagged in
+    the boolean `expensive` array (all tracks when None) and NaN for the others.
+
+    With workers > 1 the coordinate, time and offset columns are placed in shared memory and a
+    process pool works through contiguous track ranges of similar point counts. Workers write
+    the keep-mask and one row of METRIC_NAMES per track into shared output arrays, so nothing
+    but the range bounds is pickled.
+
+    Returns:
+        tuple: (mask, metrics), with metrics of shape (number of tracks, len(METRIC_NAMES)).
+    """
+    n_tracks = len(offsets) - 1
+    arrays = {
+        'LON': np.ascontiguousarray(columns['LON'], dtype=np.float64),
+        'LAT': np.ascontiguousarray(columns['LAT'], dtype=np.float64),
+        'BaseDateTime': np.ascontiguousarray(columns['BaseDateTime'], dtype=np.float64),
+        'offsets': np.ascontiguousarray(offsets, dtype=np.int64),
+        'expensive': np.ones(n_tracks, dtype=bool) if expensive is None else np.ascontiguousarray(expensive, dtype=bool),
+        'mask': np.zeros(offsets[-1], dtype=bool),
+        'metrics': np.zeros((n_tracks, len(METRIC_NAMES))),
+    }
+    if workers <= 1 or n_tracks < 2:
+        _simplify_range(*(arrays[name] for name in _SHARED_ARRAYS), 0, n_tracks, algorithm, tolerance, radius)
+        return arrays['mask'], arrays['metrics']
+
+    blocks, specs = {}, {}
+    try:
+        for name in _SHARED_ARRAYS:
+            blocks[name], specs[name] = _share_array(arrays[name])
+        with ProcessPoolExecutor(max_workers=workers, initializer=_attach_shared, initargs=(specs,)) as executor:
+            futures = [executor.submit(_simplify_shared_range, lo, hi, algorithm, tolerance, radius)
+                       for lo, hi in _track_ranges(arrays['offsets'], workers * 4)]
+            for future in tqdm(as_completed(futures), total=len(futures), desc="Compressing track ranges"):
+                future.result()
+        mask = np.ndarray(arrays['mask'].shape, bool, buffer=blocks['mask'].buf).copy()
+        metrics = np.ndarray(arrays['metrics'].shape, np.float64, buffer=blocks['metrics'].buf).copy()
+    finally:
+        for block in blocks.values():
+            block.close()
+            block.unlink()
+    return mask, metrics
+
+
+def sample_tracks(columns, offsets, rate, min_per_stratum=1):
+    """
+    Deterministic stratified sample of tracks for the DTW and Frechet evaluation.
+
+    Tracks are stratified by VesselType and log2 point-count bucket. A track is sampled when the
+    hash of its MMSI, scaled to [0, 1), is below `rate`, and the `min_per_stratum` lowest hashes
+    of every stratum are always sampled so that rare types and long tracks stay covered. The same
+    vessel is therefore picked in every run and month while it stays in the same stratum.
+
+    Returns:
+        numpy.array: Boolean mask over the tracks.
+    """
+    first = offsets[:-1]
+    score = (_mmsi_hash(columns['MMSI'][first]) >> np.uint64(11)).astype(np.float64) / 2.0 ** 53
+    strata = pd.DataFrame({
+        'type': pd.Series(columns['VesselType'][first]).fillna(''),
+        'bucket': np.log2(np.maximum(np.diff(offsets), 1)).astype(np.int64),
+    }).groupby(['type', 'bucket'], sort=False).ngroup().to_numpy()
+    rank = pd.Series(score).groupby(strata).rank(method='first').to_numpy()
+    return (score < rate) | (rank <= min_per_stratum)
+
+
+def save_masks(mask_path, masks, offsets, mmsi):
+    """
+    Save the keep-masks of a file for evaluate_deferred, concatenating those of all batches.
+
+    Args:
+        mask_path (str): Output .npz path.
+        masks (list): Keep-mask of each batch.
+        offsets (list): Track offsets of each batch.
+        mmsi (list): Track MMSIs of each batch.
+    """
+    bases = np.cumsum([0] + [len(mask) for mask in masks])
+    track_offsets = [batch[:-1] + base for batch, base in zip(offsets, bases)] + [bases[-1:]]
+    np.savez(mask_path, mask=np.concatenate([np.zeros(0, dtype=bool)] + masks),
+             offsets=np.concatenate(track_offsets), mmsi=np.concatenate([np.zeros(0, dtype=np.int64)] + mmsi))
+
+
+def evaluate_deferred(batches, mask_path, radius=DEFAULT_METRIC_RADIUS):
+    """
+    Compute DTW and Frechet of every track from masks saved by save_masks.
+
+    The original file is read again, grouped the same way as when simplifying (in memory or
+    partitioned), and each track is matched to its saved mask by MMSI.
+
+    Args:
+        batches: Iterable of (columns, offsets) of the original file.
+        mask_path (str): .npz file written by save_masks.
+        radius (int): Band radius for DTW and Frechet, None for the exact full-matrix values.
+
+    Yields:
+        pandas.DataFrame: mmsi, DTW and Frechet of the tracks of each batch.
+    """
+    saved = np.load(mask_path)
+    saved_mask, saved_offsets, saved_mmsi = saved['mask'], saved['offsets'], saved['mmsi']
+    order = np.argsort(saved_mmsi, kind='stable')
+    for columns, offsets in batches:
+        mmsi = columns['MMSI'][offsets[:-1]]
+        if len(mmsi) == 0:
+            continue
+        if len(order) == 0:
+            raise ValueError(f'{mask_path} has no masks')
+        found = np.searchsorted(saved_mmsi[order], mmsi).clip(max=len(order) - 1)
+        position = order[found]
+        if (saved_mmsi[position] != mmsi).any():
+            raise ValueError(f'{mask_path} has no mask for some tracks of this file')
+        lengths, saved_lengths = np.diff(offsets), np.diff(saved_offsets)[position]
+        bad = np.flatnonzero(saved_lengths != lengths)
+        if len(bad):
+            k = bad[0]
+            raise ValueError(f'{mask_path} does not match track {mmsi[k]}: {saved_lengths[k]} != {lengths[k]} points')
+        keep = saved_mask[_segment_points(saved_offsets[position] - 1, saved_offsets[position + 1])[0]]
+        points = np.column_stack((columns['LON'][:offsets[-1]], columns['LAT'][:offsets[-1]]))
+        dtw, frechet = _mask_distances(points, offsets, keep, radius)
+        yield pd.DataFrame({'mmsi': mmsi, 'DTW': dtw, 'Frechet': frechet})
+
+
+# Default tolerance of each simplification algorithm, in degrees (area in square degrees for vw)
+DEFAULT_TOLERANCE = {'vw': 0.000001, 'rdp': 0.1, 'tdtr': 0.1}
+
+
+def metrics_frame(columns, offsets, metrics):
+    """Per-track evaluation table in the column order written by eval_simplification."""
+    first = offsets[:-1]
+    frame = pd.DataFrame(metrics, columns=METRIC_NAMES)
+    frame['point_origin'] = frame['point_origin'].astype(np.int64)
+    frame['mmsi'] = columns['MMSI'][first]
+    frame['ship_type'] = columns['VesselType'][first]
+    return frame[['SR', 'LLR', 'DTW', 'Frechet', 'ASED', 'mmsi', 'length_origin', 'point_origin', 'ship_type']]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Simplify AIS vessel tracks and evaluate the simplification')
+    parser.add_argument('--input-dir', type=str, default='./merged/', help='Directory of merged monthly CSV files')
+    parser.add_argument('--output-dir', type=str, default='./compressed/month/', help='Output directory')
+    parser.add_argument('--algorithm', choices=['vw', 'rdp', 'tdtr'], default='vw', help='Simplification algorithm')
+    parser.add_argument('--tolerance', type=float, default=None, help='Simplification tolerance (default depends on the algorithm)')
+    parser.add_argument('--partitions', type=int, default=0, help='Group out of core in this many MMSI-hash partitions (0: in memory)')
+    parser.add_argument('--workers', type=int, default=4, help='Partitions loaded and sorted in parallel')
+    parser.add_argument('--simplify-workers', type=int, default=1, help='Processes simplifying and evaluating tracks from shared memory')
+    parser.add_argument('--metric-radius', type=int, default=DEFAULT_METRIC_RADIUS, help='Band radius of DTW and Frechet (0: exact, full matrix)')
+    parser.add_argument('--evaluate', choices=['all', 'sample', 'cheap'], default='all', help='Tracks that get DTW and Frechet: all, a stratified sample, or none (SR, LLR and ASED only)')
+    parser.add_argument('--sample-rate', type=float, default=0.05, help='Fraction of tracks sampled by --evaluate sample')
+    parser.add_argument('--min-per-stratum', type=int, default=1, help='Tracks always sampled per VesselType and point-count stratum')
+    parser.add_argument('--save-masks', action='store_true', help='Save the keep-masks of each file for --evaluate-deferred')
+    parser.add_argument('--evaluate-deferred', action='store_true', help='Only compute DTW and Frechet of all tracks from masks saved by --save-masks')
+    parser.add_argument('--scratch-dir', type=str, default=None, help='Root for partition files (default: $NOAA_SCRATCH_DIR or the system temp dir)')
+    args = parser.parse_args()
+
+    input_folder = args.input_dir
+    output_folder = args.output_dir
+    simp_algorithm = args.algorithm
+    tolerance = args.tolerance if args.tolerance is not None else DEFAULT_TOLERANCE[simp_algorithm]
+    radius = args.metric_radius or None
+    csv_files = sorted(f for f in os.listdir(input_folder) if f.endswith('.csv'))
     if not os.path.exists(output_folder):
         os.makedirs(output_folder)
 
@@ -338,24 +916,41 @@ if __name__ == "__main__":
         file_path = os.path.join(input_folder, file)
         write_path = os.path.join(output_folder, f'{simp_algorithm}_{file}')
         eval_path = os.path.join(output_folder, f'eval_{simp_algorithm}_{file}')
-        # grouped_data = read_and_group_csv(file_path)
-        # Print grouped data for verification
-        # simplified_trajectories = []
-        first_write = True
-        # for mmsi, track in tqdm(grouped_data.items(), desc="Compressing tracks"):
-        for mmsi, track in tqdm(read_and_group_csv_generator(file_path), desc="Compressing tracks"):
-            first = False
-            points = np.column_stack((track['LON'], track['LAT']))
-            mask = visvalingam_whyatt(points, threshold=0.000001)
-            # mask = douglas_peucker(points, epsilon=0.1)
-            # mask = td_tr(points, track['BaseDateTime'], 0.1)
-            compressed_track = dict(
-                **{k: np.array(track[k])[mask] for k in track.keys()},
-            )
-            # print(f"MMSI: {mmsi}, track length: {len(track['LON'])}, compressed length: {len(compressed_track['LON'])}")
-            # simplified_trajectories.append(compressed_track)
-            write_and_save_dict(compressed_track, write_path, first_write)
-            write_and_save_eval_metrics(eval_simplification(track, compressed_track), eval_path, first_write)
-            first_write = False
-
-        break
\ No newline at end of file
+        mask_path = os.path.join(output_folder, f'mask_{simp_algorithm}_{os.path.splitext(file)[0]}.npz')
+
+        with ScratchSpace(args.scratch_dir, prefix='simplify') as scratch:
+            if args.partitions > 0:
+                batches = iter_partitions(file_path, scratch.path, args.partitions, args.workers)
+            else:
+                batches = [_load_sorted_columns(file_path)]
+
+            first_write = True
+            if args.evaluate_deferred:
+                deferred_path = os.path.join(output_folder, f'deferred_eval_{simp_algorithm}_{file}')
+                for frame in evaluate_deferred(batches, mask_path, radius):
+                    write_and_save_dict(frame, deferred_path, first_write)
+                    first_write = False
+                continue
+
+            saved = {'masks': [], 'offsets': [], 'mmsi': []}
+            for columns, offsets in batches:
+                expensive = None
+                if args.evaluate == 'sample':
+                    expensive = sample_tracks(columns, offsets, args.sample_rate, args.min_per_stratum)
+                elif args.evaluate == 'cheap':
+                    expensive = np.zeros(len(offsets) - 1, dtype=bool)
+                mask, metrics = simplify_and_evaluate(columns, offsets, simp_algorithm, tolerance, args.simplify_workers,
+                                                      radius, expensive)
+                write_and_save_dict({col: values[mask] for col, values in columns.items()}, write_path, first_write)
+                write_and_save_dict(metrics_frame(columns, offsets, metrics), eval_path, first_write)
+                first_write = False
+                if args.save_masks:
+                    saved['masks'].append(mask)
+                    saved['offsets'].append(offsets)
+                    saved['mmsi'].append(columns['MMSI'][offsets[:-1]])
+            if args.save_masks:
+                save_masks(mask_path, saved['masks'], saved['offsets'], saved['mmsi'])
+
+
+if __name__ == "__main__":
+    main()
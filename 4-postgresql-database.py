@@ -1,48 +1,126 @@
 import os
 import aisdb
+import numpy as np
 import pandas as pd
 from glob import glob
-
-
-def noaa2spire(csv_file, output_dir):
-    df = pd.read_csv(csv_file, parse_dates=["BaseDateTime"])
-    # Spire data headers
-    list_of_headers_ = ["MMSI","Message_ID","Repeat_indicator","Time","Millisecond","Region","Country","Base_station","Online_data","Group_code","Sequence_ID","Channel","Data_length","Vessel_Name","Call_sign","IMO","Ship_Type","Dimension_to_Bow","Dimension_to_stern","Dimension_to_port","Dimension_to_starboard","Draught","Destination","AIS_version","Navigational_status","ROT","SOG","Accuracy","Longitude","Latitude","COG","Heading","Regional","Maneuver","RAIM_flag","Communication_flag","Communication_state","UTC_year","UTC_month","UTC_day","UTC_hour","UTC_minute","UTC_second","Fixing_device","Transmission_control","ETA_month","ETA_day","ETA_hour","ETA_minute","Sequence","Destination_ID","Retransmit_flag","Country_code","Functional_ID","Data","Destination_ID_1","Sequence_1","Destination_ID_2","Sequence_2","Destination_ID_3","Sequence_3","Destination_ID_4","Sequence_4","Altitude","Altitude_sensor","Data_terminal","Mode","Safety_text","Non-standard_bits","Name_extension","Name_extension_padding","Message_ID_1_1","Offset_1_1","Message_ID_1_2","Offset_1_2","Message_ID_2_1","Offset_2_1","Destination_ID_A","Offset_A","Increment_A","Destination_ID_B","offsetB","incrementB","data_msg_type","station_ID","Z_count","num_data_words","health","unit_flag","display","DSC","band","msg22","offset1","num_slots1","timeout1","Increment_1","Offset_2","Number_slots_2","Timeout_2","Increment_2","Offset_3","Number_slots_3","Timeout_3","Increment_3","Offset_4","Number_slots_4","Timeout_4","Increment_4","ATON_type","ATON_name","off_position","ATON_status","Virtual_ATON","Channel_A","Channel_B","Tx_Rx_mode","Power","Message_indicator","Channel_A_bandwidth","Channel_B_bandwidth","Transzone_size","Longitude_1","Latitude_1","Longitude_2","Latitude_2","Station_Type","Report_Interval","Quiet_Time","Part_Number","Vendor_ID","Mother_ship_MMSI","Destination_indicator","Binary_flag","GNSS_status","spare","spare2","spare3","spare4"]
-    # Create a new dataframe with the specified headers
-    df_new = pd.DataFrame(columns=list_of_headers_)
-
-    # Populate the new dataframe with formatted data from the original dataframe
-    df_new['Time'] = pd.to_datetime(df['BaseDateTime']).dt.strftime('%Y%m%d_%H%M%S')
-    df_new['Latitude'] = df['LAT']
-    df_new['Longitude'] = df['LON']
-    df_new['Vessel_Name'] = df['VesselName']
-    df_new['Call_sign'] = df['CallSign']
-    df_new['Ship_Type'] = df['VesselType'].fillna(0).astype(int)
-    df_new['Navigational_status'] = df['Status']
-    df_new['Draught'] = df['Draft']
-    df_new['Message_ID'] = 1  # Mark all messages as dynamic by default
-    df_new['Millisecond'] = 0
-
-    # Transfer additional columns from the original dataframe, if they exist
-    for col_n in df_new:
-        if col_n in df.columns:
-            df_new[col_n] = df[col_n]
-
-    # Extract static messages for each unique vessel
-    filtered_df = df_new[df_new['Ship_Type'].notnull() & (df_new['Ship_Type'] != 0)]
-    filtered_df = filtered_df.drop_duplicates(subset='MMSI', keep='first')
-    filtered_df = filtered_df.reset_index(drop=True)
-    filtered_df['Message_ID'] = 5  # Mark these as static messages
-
-    # Merge dynamic and static messages into a single dataframe
-    df_new = pd.concat([filtered_df, df_new])
-
+from util import StaticChangeTracker
+
+
+# Spire data headers
+SPIRE_HEADERS = ["MMSI","Message_ID","Repeat_indicator","Time","Millisecond","Region","Country","Base_station","Online_data","Group_code","Sequence_ID","Channel","Data_length","Vessel_Name","Call_sign","IMO","Ship_Type","Dimension_to_Bow","Dimension_to_stern","Dimension_to_port","Dimension_to_starboard","Draught","Destination","AIS_version","Navigational_status","ROT","SOG","Accuracy","Longitude","Latitude","COG","Heading","Regional","Maneuver","RAIM_flag","Communication_flag","Communication_state","UTC_year","UTC_month","UTC_day","UTC_hour","UTC_minute","UTC_second","Fixing_device","Transmission_control","ETA_month","ETA_day","ETA_hour","ETA_minute","Sequence","Destination_ID","Retransmit_flag","Country_code","Functional_ID","Data","Destination_ID_1","Sequence_1","Destination_ID_2","Sequence_2","Destination_ID_3","Sequence_3","Destination_ID_4","Sequence_4","Altitude","Altitude_sensor","Data_terminal","Mode","Safety_text","Non-standard_bits","Name_extension","Name_extension_padding","Message_ID_1_1","Offset_1_1","Message_ID_1_2","Offset_1_2","Message_ID_2_1","Offset_2_1","Destination_ID_A","Offset_A","Increment_A","Destination_ID_B","offsetB","incrementB","data_msg_type","station_ID","Z_count","num_data_words","health","unit_flag","display","DSC","band","msg22","offset1","num_slots1","timeout1","Increment_1","Offset_2","Number_slots_2","Timeout_2","Increment_2","Offset_3","Number_slots_3","Timeout_3","Increment_3","Offset_4","Number_slots_4","Timeout_4","Increment_4","ATON_type","ATON_name","off_position","ATON_status","Virtual_ATON","Channel_A","Channel_B","Tx_Rx_mode","Power","Message_indicator","Channel_A_bandwidth","Channel_B_bandwidth","Transzone_size","Longitude_1","Latitude_1","Longitude_2","Latitude_2","Station_Type","Report_Interval","Quiet_Time","Part_Number","Vendor_ID","Mother_ship_MMSI","Destination_indicator","Binary_flag","GNSS_status","spare","spare2","spare3","spare4"]
+
+# Spire column -> NOAA column copied into it; every other Spire column is written empty.
+# Dynamic messages carry position and kinematics, static messages the vessel attributes.
+NOAA_TO_SPIRE_DYNAMIC = {
+    'MMSI': 'MMSI',
+    'Navigational_status': 'Status',
+    'SOG': 'SOG',
+    'Longitude': 'LON',
+    'Latitude': 'LAT',
+    'COG': 'COG',
+    'Heading': 'Heading',
+}
+NOAA_TO_SPIRE_STATIC = {
+    'MMSI': 'MMSI',
+    'Vessel_Name': 'VesselName',
+    'Call_sign': 'CallSign',
+    'IMO': 'IMO',
+    'Draught': 'Draft',
+}
+
+# Byte offsets of YYYYMMDD and HHMMSS in a NOAA BaseDateTime 'YYYY-MM-DDTHH:MM:SS'
+_DATE_BYTES = [0, 1, 2, 3, 5, 6, 8, 9]
+_TIME_BYTES = [11, 12, 14, 15, 17, 18]
+
+
+def spire_time(base_datetime: pd.Series) -> np.ndarray:
+    """
+    Format NOAA BaseDateTime strings as Spire YYYYMMDD_HHMMSS by slicing their bytes, without
+    parsing dates. Values not in the fixed NOAA layout fall back to pandas parsing.
+    """
+    text = base_datetime.to_numpy(dtype=str)
+    lengths = np.char.str_len(text)
+    if len(text) == 0 or (lengths != 19).any():
+        return pd.to_datetime(base_datetime).dt.strftime('%Y%m%d_%H%M%S').to_numpy(dtype=object)
+    raw = text.astype('S19').view(np.uint8).reshape(-1, 19)
+    out = np.empty((len(raw), 15), dtype=np.uint8)
+    out[:, :8] = raw[:, _DATE_BYTES]
+    out[:, 8] = ord('_')
+    out[:, 9:] = raw[:, _TIME_BYTES]
+    return out.view('S15').ravel().astype(str).astype(object)
+
+
+def _quote(values) -> np.ndarray:
+    """Quote one column the way csv.QUOTE_ALL does; missing values become an empty quoted field."""
+    series = pd.Series(values)
+    if series.dtype.kind == 'f':
+        valid = series.dropna()
+        if (valid == np.floor(valid)).all():
+            series = series.astype('Int64')
+    missing = series.isna().to_numpy()
+    text = series.astype(str).str.replace('"', '""', regex=False).to_numpy(dtype=object)
+    text[missing] = ''
+    return '"' + text + '"'
+
+
+def _spire_lines(fields: dict, rows: int) -> np.ndarray:
+    """
+    Assemble Spire CSV lines from the quoted populated columns in `fields`. Runs of empty
+    columns between them are written as one constant string instead of being materialised.
+    """
+    lines = np.full(rows, '', dtype=object)
+    pending = ''
+    for i, header in enumerate(SPIRE_HEADERS):
+        pending += ',' if i else ''
+        if header in fields:
+            lines = lines + pending + fields[header]
+            pending = ''
+        else:
+            pending += '""'
+    return lines + pending + '\n'
+
+
+def noaa2spire(csv_file, output_dir, chunksize: int = 500000):
+    """
+    Convert a NOAA CSV file to the Spire CSV layout read by aisdb.decode_msgs.
+
+    The file is streamed in chunks. Only the populated Spire columns are built, and the remaining
+    columns are written as constant empty fields. Every NOAA row becomes a dynamic message
+    (Message_ID 1) with position and kinematics only. A static message (Message_ID 5) is written
+    when a vessel first reports its attributes and again whenever they change, ahead of the
+    dynamic rows of its chunk.
+
+    Args:
+        csv_file: NOAA CSV file to convert
+        output_dir: Directory for the {name}_aisdb.csv output
+        chunksize: Rows converted at a time
+    """
     # Get the base filename from the input path
     base_filename = os.path.basename(csv_file)
     output_filename = base_filename.replace('.csv', '_aisdb.csv')
 
-    # Save the final dataframe to a CSV file using the input filename
-    df_new.to_csv(os.path.join(output_dir, output_filename), index=False, quoting=1)
+    statics = StaticChangeTracker()
+    with open(os.path.join(output_dir, output_filename), 'w') as out:
+        out.write(','.join(f'"{h}"' for h in SPIRE_HEADERS) + '\n')
+        for df in pd.read_csv(csv_file, chunksize=chunksize, dtype={'BaseDateTime': str}):
+            time = _quote(spire_time(df['BaseDateTime']))
+
+            # Static messages only where a vessel's attributes changed
+            changed = statics.changes(df['MMSI'].to_numpy(), df['BaseDateTime'].to_numpy(dtype=str), df)
+            if changed.any():
+                static = df[changed]
+                fields = {spire: _quote(static[noaa]) for spire, noaa in NOAA_TO_SPIRE_STATIC.items()}
+                fields['Ship_Type'] = _quote(static['VesselType'].fillna(0).astype(int))
+                fields['Time'] = time[changed]
+                fields['Millisecond'] = '"0"'
+                fields['Message_ID'] = '"5"'
+                out.writelines(_spire_lines(fields, len(static)))
+
+            fields = {spire: _quote(df[noaa]) for spire, noaa in NOAA_TO_SPIRE_DYNAMIC.items()}
+            fields['Time'] = time
+            fields['Millisecond'] = '"0"'
+            fields['Message_ID'] = '"1"'  # Mark all messages as dynamic
+            out.writelines(_spire_lines(fields, len(df)))
 
 
 def db_connection():
@@ -0,0 +1,38 @@
+"""
+Post-load indexing for SQLite databases built by 3-sqlite-noaa.py or 3-copy-noaa.py.
+This script builds an R*Tree over (lon, lat, time) and a covering (mmsi, time) index for every
+month table, and can run a bbox-plus-time query through them to check the result.
+"""
+
+import argparse
+import time
+import pandas as pd
+from util import build_sqlite_rtree, query_sqlite_tracks
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Build R*Tree spatial and time indexes for an AISdb SQLite database')
+    parser.add_argument('--dbpath', type=str, default='./marine_cadastre_NE_2023_Jan_Feb.db', help='SQLite database path')
+    parser.add_argument('--bucket-seconds', type=int, default=3600, help='Time span of one R*Tree box per vessel')
+    parser.add_argument('--rebuild', action='store_true', help='Rebuild R*Trees that already exist')
+    parser.add_argument('--query-bbox', type=str, default=None, help='Test query box as min_lon,min_lat,max_lon,max_lat')
+    parser.add_argument('--query-start', type=str, default='2023-01-01', help='Test query start time')
+    parser.add_argument('--query-end', type=str, default='2023-01-31', help='Test query end time')
+    args = parser.parse_args()
+
+    start_time = time.time()
+    build_sqlite_rtree(args.dbpath, args.bucket_seconds, args.rebuild)
+    print(f"Indexing time: {time.time() - start_time:.2f} seconds")
+
+    if args.query_bbox:
+        bbox = tuple(float(v) for v in args.query_bbox.split(','))
+        start = int(pd.Timestamp(args.query_start).timestamp())
+        end = int(pd.Timestamp(args.query_end).timestamp())
+        start_time = time.time()
+        rows = query_sqlite_tracks(args.dbpath, bbox, start, end)
+        vessels = len({r[0] for r in rows})
+        print(f"Query returned {len(rows)} reports from {vessels} vessels in {time.time() - start_time:.3f} seconds")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+"""
+Post-load optimisation of the TimescaleDB hypertables written by 3-psql-noaa.py.
+For every ais_{YYYYMM}_dynamic hypertable this script
+  1. picks a chunk interval from the observed row rate, so chunks hold about --target-chunk-rows rows.
+     set_chunk_time_interval only affects chunks created later, so completed months are re-chunked
+     by copying them into a new hypertable with that interval; the current month gets the interval
+     for its remaining chunks,
+  2. builds secondary indexes after the bulk load, several tables in parallel and one transaction per chunk,
+  3. enables compression segmented by mmsi and ordered by time (then the other primary-key columns,
+     which TimescaleDB requires), and compresses completed months.
+"""
+
+import argparse
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import psycopg
+
+# psql connection string
+USER = 'ruixin'
+PASSWORD = 'ruixin123'
+ADDRESS = '127.0.0.1'
+PORT = 5432
+DBNAME = 'noaa'
+psql_conn_string = f"postgresql://{USER}:{PASSWORD}@{ADDRESS}:{PORT}/{DBNAME}"
+
+# Secondary indexes built after loading: name suffix -> column list
+SECONDARY_INDEXES = {
+    'mmsi_time': '(mmsi, time DESC)',
+    'lonlat': '(longitude, latitude)',
+}
+
+
+def list_hypertables(conn) -> list:
+    rows = conn.execute(
+        "SELECT hypertable_name FROM timescaledb_information.hypertables "
+        "WHERE hypertable_name LIKE 'ais\\_%\\_dynamic' ORDER BY hypertable_name").fetchall()
+    return [r[0] for r in rows]
+
+
+def choose_chunk_interval(conn, table: str, target_rows: int, min_seconds: int, max_seconds: int) -> int:
+    """
+    Pick a chunk interval (seconds) that gives about target_rows rows per chunk at the row rate
+    observed in the table, clamped to [min_seconds, max_seconds].
+    """
+    count, first, last = conn.execute(f"SELECT COUNT(*), MIN(time), MAX(time) FROM {table}").fetchone()
+    if not count or last is None or last <= first:
+        return max_seconds
+    rows_per_second = count / (last - first)
+    return int(min(max(target_rows / rows_per_second, min_seconds), max_seconds))
+
+
+def current_chunk_interval(conn, table: str):
+    """Chunk interval of the time dimension of a hypertable, None if unknown."""
+    row = conn.execute(
+        "SELECT integer_interval FROM timescaledb_information.dimensions "
+        "WHERE hypertable_name = %s AND column_name = 'time'", (table,)).fetchone()
+    return row[0] if row else None
+
+
+def primary_key_columns(conn, table: str) -> list:
+    """Columns of a table's primary key, in key order."""
+    rows = conn.execute(
+        "SELECT a.attname FROM pg_index i "
+        "JOIN pg_attribute a ON a.attrelid = i.indrelid AND a.attnum = ANY(i.indkey) "
+        "WHERE i.indrelid = %s::regclass AND i.indisprimary "
+        "ORDER BY array_position(i.indkey::int2[], a.attnum)", (table,)).fetchall()
+    return [r[0] for r in rows]
+
+
+def rechunk_table(conn, table: str, interval: int) -> int:
+    """
+    Apply a chunk interval to the rows already in a hypertable. A new hypertable with the same
+    columns and primary key is created with the interval, filled in time order and swapped in for
+    the old one in a single transaction. Secondary indexes and compression are (re)built by the
+    later steps. Returns the number of rows copied.
+    """
+    new = f"{table}_rechunk"
+    key = primary_key_columns(conn, table)
+    with conn.transaction():
+        conn.execute(f"DROP TABLE IF EXISTS {new}")
+        conn.execute(f"CREATE TABLE {new} (LIKE {table} INCLUDING DEFAULTS)")
+        if key:
+            conn.execute(f"ALTER TABLE {new} ADD CONSTRAINT {new}_pkey PRIMARY KEY ({', '.join(key)})")
+        conn.execute("SELECT create_hypertable(%s::regclass, 'time', chunk_time_interval => %s::integer)",
+                     (new, interval))
+        rows = conn.execute(f"INSERT INTO {new} SELECT * FROM {table} ORDER BY time").rowcount
+        conn.execute(f"DROP TABLE {table}")
+        conn.execute(f"ALTER TABLE {new} RENAME TO {table}")
+        if key:
+            conn.execute(f"ALTER TABLE {table} RENAME CONSTRAINT {new}_pkey TO {table}_pkey")
+    return rows
+
+
+def build_index(table: str, suffix: str, columns: str, maintenance_mem: str) -> tuple:
+    """Build one secondary index with its own connection; returns (table, suffix, seconds)."""
+    start_time = time.time()
+    # transaction_per_chunk cannot run inside a transaction block
+    with psycopg.connect(psql_conn_string, autocommit=True) as conn:
+        conn.execute(f"SET maintenance_work_mem = '{maintenance_mem}'")
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{suffix} ON {table} {columns} "
+                     f"WITH (timescaledb.transaction_per_chunk)")
+    return table, suffix, time.time() - start_time
+
+
+def compress_table(conn, table: str) -> int:
+    """
+    Enable compression on a hypertable and compress all of its chunks; returns the chunk count.
+    Every column of a unique index must be in segmentby or orderby, so the primary-key columns
+    other than mmsi follow time in orderby, e.g. 'time, longitude, latitude, source'.
+    """
+    orderby = ['time'] + [c for c in primary_key_columns(conn, table) if c not in ('mmsi', 'time')]
+    conn.execute(f"ALTER TABLE {table} SET (timescaledb.compress, "
+                 f"timescaledb.compress_segmentby = 'mmsi', timescaledb.compress_orderby = '{', '.join(orderby)}')")
+    chunks = conn.execute("SELECT show_chunks(%s::regclass)::text", (table,)).fetchall()
+    for (chunk,) in chunks:
+        conn.execute("SELECT compress_chunk(%s::regclass, if_not_compressed => true)", (chunk,))
+    return len(chunks)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Tune chunking, indexes and compression of AIS hypertables after loading')
+    parser.add_argument('--target-chunk-rows', type=int, default=25000000, help='Rows per chunk used to pick the chunk interval')
+    parser.add_argument('--min-chunk-days', type=float, default=1, help='Smallest chunk interval in days')
+    parser.add_argument('--max-chunk-days', type=float, default=31, help='Largest chunk interval in days')
+    parser.add_argument('--rechunk-tolerance', type=float, default=0.25, help='Re-chunk a completed month when its interval is off by more than this fraction')
+    parser.add_argument('--no-rechunk', action='store_true', help='Only set the interval of chunks created later, never copy completed months')
+    parser.add_argument('--index-workers', type=int, default=4, help='Indexes built in parallel')
+    parser.add_argument('--maintenance-work-mem', type=str, default='2GB', help='maintenance_work_mem per index build')
+    parser.add_argument('--no-compress', action='store_true', help='Skip compression')
+    args = parser.parse_args()
+
+    overall_start_time = time.time()
+    current_month = datetime.now(timezone.utc).strftime('%Y%m')
+
+    with psycopg.connect(psql_conn_string, autocommit=True) as conn:
+        tables = list_hypertables(conn)
+        print(f'Found {len(tables)} hypertables')
+
+        # 1. chunk interval from the observed row rate: completed months are copied into chunks of
+        # that interval, the current month gets it for the chunks it creates from now on
+        for table in tables:
+            interval = choose_chunk_interval(conn, table, args.target_chunk_rows,
+                                             int(args.min_chunk_days * 86400), int(args.max_chunk_days * 86400))
+            current = current_chunk_interval(conn, table)
+            if table.split('_')[1] < current_month and not args.no_rechunk:
+                if current and abs(current - interval) <= args.rechunk_tolerance * current:
+                    print(f'{table}: chunk interval {current / 86400:.2f} days kept')
+                    continue
+                start_time = time.time()
+                try:
+                    rows = rechunk_table(conn, table, interval)
+                    print(f'{table}: re-chunked {rows} rows at {interval / 86400:.2f} days in '
+                          f'{time.time() - start_time:.2f} seconds')
+                except Exception as e:
+                    print(f'Error re-chunking {table}: {e}')
+                continue
+            # aisdb stores time as INTEGER epoch seconds, so the interval is an integer too
+            conn.execute("SELECT set_chunk_time_interval(%s::regclass, %s::integer)", (table, interval))
+            print(f'{table}: chunk interval set to {interval / 86400:.2f} days for new chunks')
+
+        # 2. secondary indexes, built after the bulk load and in parallel across tables
+        with ThreadPoolExecutor(max_workers=args.index_workers) as executor:
+            futures = [executor.submit(build_index, table, suffix, columns, args.maintenance_work_mem)
+                       for table in tables for suffix, columns in SECONDARY_INDEXES.items()]
+            for future in as_completed(futures):
+                try:
+                    table, suffix, elapsed = future.result()
+                    print(f'Built idx_{table}_{suffix} in {elapsed:.2f} seconds')
+                except Exception as e:
+                    print(f'Error building index: {e}')
+
+        # 3. compression of completed months, segmented by vessel and ordered by time
+        if not args.no_compress:
+            for table in tables:
+                month = table.split('_')[1]
+                if month >= current_month:
+                    print(f'{table}: month not complete, not compressed')
+                    continue
+                start_time = time.time()
+                try:
+                    chunks = compress_table(conn, table)
+                    print(f'{table}: compressed {chunks} chunks in {time.time() - start_time:.2f} seconds')
+                except Exception as e:
+                    print(f'Error compressing {table}: {e}')
+
+    print(f'Total execution time: {time.time() - overall_start_time:.2f} seconds')
+
+
+if __name__ == "__main__":
+    main()
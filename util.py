@@ -1,8 +1,22 @@
 # util.py
 import pandas as pd
+import numpy as np
 import os
 import csv
-from typing import List, Tuple, Optional
+import json
+import time
+import shutil
+import hashlib
+import re
+import sqlite3
+import tempfile
+from contextlib import contextmanager
+from typing import List, Tuple, Optional, Dict, Iterator
+
+try:
+    import psycopg
+except ImportError:
+    psycopg = None
 
 def filter_by_bbox(
     file_paths: List[str],
@@ -195,16 +209,1083 @@ def filter_by_bbox(
     
     return filtered_file_paths
 
-def clean_tmp_folders():
-    """Remove all /tmp/tmp* directories before retrying."""
-    import glob
-    import shutil
-    
-    tmp_dirs = glob.glob('/tmp/tmp*')
-    for tmp_dir in tmp_dirs:
-        if os.path.isdir(tmp_dir):
-            try:
-                shutil.rmtree(tmp_dir)
-                print(f"Removed temporary directory: {tmp_dir}")
-            except Exception as e:
-                print(f"Error removing {tmp_dir}: {e}")
+def file_signature(file_path: str) -> List:
+    """Identify a file by path, size and modification time without reading it."""
+    st = os.stat(file_path)
+    return [os.path.abspath(file_path), st.st_size, st.st_mtime_ns]
+
+
+def bbox_contains(outer: Tuple[float, float, float, float], inner: Tuple[float, float, float, float]) -> bool:
+    """Return True if bounding box `inner` lies entirely within `outer`."""
+    return (outer[0] <= inner[0] and outer[1] <= inner[1] and
+            outer[2] >= inner[2] and outer[3] >= inner[3])
+
+
+class FilterCache:
+    """
+    Disk cache of bounding-box filter results, indexed by a JSON file in the cache directory.
+
+    Each entry records the month, the bbox, the signatures of the source files and the filtered
+    outputs. A repeated bbox is served straight from the cache, a bbox contained in a cached one
+    is filtered from the smaller cached output, and least-recently-used entries are evicted once
+    the cache directory exceeds the disk quota. Usage is measured on disk at eviction time, and an
+    evicted file only counts as freed when no hard link (e.g. in an output directory) still holds it.
+    Entries that would free nothing are kept, and the quota is reported as unmet instead.
+    """
+
+    def __init__(self, cache_dir: str, quota_bytes: int):
+        self.cache_dir = cache_dir
+        self.quota_bytes = quota_bytes
+        self.index_path = os.path.join(cache_dir, "cache_index.json")
+        os.makedirs(cache_dir, exist_ok=True)
+        self.entries: Dict[str, dict] = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+
+    def _save(self):
+        tmp_path = self.index_path + ".tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp_path, self.index_path)
+
+    @staticmethod
+    def _key(month: str, bbox: Tuple[float, float, float, float], sources: List) -> str:
+        digest = hashlib.sha1(json.dumps([list(bbox), sources]).encode()).hexdigest()[:12]
+        return f"{month}_{digest}"
+
+    def entry_dir(self, month: str, bbox: Tuple[float, float, float, float], sources: List) -> str:
+        """Directory that holds the outputs of the entry for this month, bbox and sources."""
+        return os.path.join(self.cache_dir, self._key(month, bbox, sources))
+
+    def lookup(self, month: str, bbox: Tuple[float, float, float, float], sources: List) -> Tuple[Optional[dict], bool]:
+        """
+        Find the best cached entry for a filter request.
+
+        Returns:
+            tuple: (entry, exact). `entry` is None on a miss; `exact` is True when the cached bbox
+            equals the requested one, otherwise the entry is the smallest cached superset.
+        """
+        best = None
+        for entry in self.entries.values():
+            if entry['month'] != month or entry['sources'] != sources:
+                continue
+            if not all(os.path.exists(p) for p in entry['outputs']):
+                continue
+            if tuple(entry['bbox']) == tuple(bbox):
+                self.touch(entry)
+                return entry, True
+            if bbox_contains(entry['bbox'], bbox) and (best is None or entry['bytes'] < best['bytes']):
+                best = entry
+        if best is not None:
+            self.touch(best)
+        return best, False
+
+    def touch(self, entry: dict):
+        entry['last_used'] = time.time()
+        self._save()
+
+    def add(self, month: str, bbox: Tuple[float, float, float, float], sources: List, outputs: List[str]) -> dict:
+        """Record a freshly filtered result and evict old entries if the quota is exceeded."""
+        key = self._key(month, bbox, sources)
+        entry = {
+            'month': month,
+            'bbox': list(bbox),
+            'sources': sources,
+            'outputs': outputs,
+            'bytes': sum(os.path.getsize(p) for p in outputs),
+            'last_used': time.time(),
+        }
+        self.entries[key] = entry
+        self.evict(keep=key)
+        self._save()
+        return entry
+
+    def _entry_bytes(self, key: str) -> Tuple[int, int]:
+        """(bytes on disk, bytes freed by deleting it) of an entry's directory."""
+        used = freed = 0
+        for root, _, files in os.walk(os.path.join(self.cache_dir, key)):
+            for name in files:
+                try:
+                    st = os.stat(os.path.join(root, name))
+                except OSError:
+                    continue
+                used += st.st_size
+                if st.st_nlink <= 1:
+                    freed += st.st_size
+        return used, freed
+
+    def evict(self, keep: Optional[str] = None):
+        """Remove least-recently-used entries until the cache directory fits in the quota."""
+        sizes = {key: self._entry_bytes(key) for key in self.entries}
+        total = sum(used for used, _ in sizes.values())
+        for key in sorted(self.entries, key=lambda k: self.entries[k]['last_used']):
+            if total <= self.quota_bytes:
+                break
+            if key == keep or sizes[key][1] == 0:
+                continue  # deleting an entry whose files are all linked elsewhere frees nothing
+            total -= sizes[key][1]
+            shutil.rmtree(os.path.join(self.cache_dir, key), ignore_errors=True)
+            del self.entries[key]
+            print(f"Evicted cached filter result: {key}")
+        if total > self.quota_bytes:
+            print(f"Filter cache quota cannot be met: {total / 1024 ** 3:.1f} GB in use, the remaining "
+                  f"entries are hard linked into output directories and are kept")
+
+
+def link_or_copy(file_paths: List[str], output_dir: str) -> List[str]:
+    """
+    Place files into output_dir, replacing any CSV files already there.
+    Hard links are used when possible so cached outputs are not duplicated on disk.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    for old in os.listdir(output_dir):
+        if old.endswith('.csv'):
+            os.remove(os.path.join(output_dir, old))
+
+    placed = []
+    for file_path in file_paths:
+        dst = os.path.join(output_dir, os.path.basename(file_path))
+        try:
+            os.link(file_path, dst)
+        except OSError:
+            shutil.copy2(file_path, dst)
+        placed.append(dst)
+    return placed
+
+
+class HashDedup:
+    """
+    Set of row fingerprints in an open-addressing hash table backed by numpy arrays.
+
+    Each row is reduced to a 64-bit fingerprint; with `verify=True` a second, independent 64-bit
+    hash is stored alongside it and two rows only count as equal when both match. A slot takes 8
+    or 16 bytes. The table uses linear probing and is resized once it is MAX_LOAD full, to a load
+    of GROW_LOAD, so it holds 1.2-1.7 slots per row: about 9-14 bytes per row, or 19-27 with
+    verify, instead of a Python string per row.
+    """
+
+    MAX_LOAD = 0.85
+    GROW_LOAD = 0.6
+
+    def __init__(self, capacity: int = 1 << 20, verify: bool = True):
+        self.verify = verify
+        self.count = 0
+        self._alloc(max(int(capacity / self.MAX_LOAD) + 1, 8))
+
+    def _alloc(self, size: int):
+        self.size = np.uint64(size)
+        self.fingerprints = np.zeros(size, dtype=np.uint64)  # 0 marks an empty slot
+        self.checks = np.zeros(size, dtype=np.uint64) if self.verify else None
+
+    @property
+    def nbytes(self) -> int:
+        return self.fingerprints.nbytes + (self.checks.nbytes if self.verify else 0)
+
+    @staticmethod
+    def fingerprint(rows: List[bytes]) -> Tuple[np.ndarray, np.ndarray]:
+        """Hash rows to (fingerprint, check) uint64 arrays using one 128-bit BLAKE2b digest per row."""
+        digests = np.frombuffer(
+            b''.join(hashlib.blake2b(r, digest_size=16).digest() for r in rows), dtype=np.uint64
+        ).reshape(-1, 2)
+        fps = digests[:, 0].copy()
+        fps[fps == 0] = 1
+        return fps, digests[:, 1].copy()
+
+    def add(self, fps: np.ndarray, checks: Optional[np.ndarray] = None) -> np.ndarray:
+        """
+        Insert a batch of fingerprints.
+
+        Returns:
+            Boolean array, True where the row had not been seen before (earlier rows in the
+            batch win over later ones).
+        """
+        if not self.verify:
+            checks = np.zeros(len(fps), dtype=np.uint64)
+        # Resolve duplicates inside the batch first so every probing key below is distinct
+        keys = np.column_stack((fps, checks)).view('V16').ravel() if self.verify else fps
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        is_new = np.zeros(len(fps), dtype=bool)
+
+        if self.count + len(first) > self.MAX_LOAD * len(self.fingerprints):
+            self._grow(self.count + len(first))
+
+        inserted = self._insert(fps[first], checks[first])
+        is_new[first[inserted]] = True
+        return is_new
+
+    def _insert(self, fps: np.ndarray, checks: np.ndarray) -> np.ndarray:
+        pending = np.arange(len(fps))
+        slots = fps % self.size
+        inserted = np.zeros(len(fps), dtype=bool)
+
+        while len(pending):
+            cur = self.fingerprints[slots]
+            same = cur == fps[pending]
+            if self.verify:
+                same &= self.checks[slots] == checks[pending]
+            empty = cur == 0
+
+            # Claim empty slots; when several keys race for one slot the first one wins
+            claim = np.flatnonzero(empty)
+            _, winners = np.unique(slots[claim], return_index=True)
+            won = claim[winners]
+            self.fingerprints[slots[won]] = fps[pending[won]]
+            if self.verify:
+                self.checks[slots[won]] = checks[pending[won]]
+            inserted[pending[won]] = True
+            self.count += len(won)
+
+            done = same.copy()
+            done[won] = True
+            # Keys that lost a race retry the same slot, everything else probes onwards
+            advance = ~done & ~empty
+            slots[advance] = (slots[advance] + np.uint64(1)) % self.size
+            pending, slots = pending[~done], slots[~done]
+
+        return inserted
+
+    def _grow(self, needed: int):
+        old_fps, old_checks = self.fingerprints, self.checks
+        self._alloc(int(needed / self.GROW_LOAD) + 1)
+        self.count = 0
+        used = old_fps != 0
+        self._insert(old_fps[used], old_checks[used] if self.verify else np.zeros(int(used.sum()), dtype=np.uint64))
+
+
+# AISdb table layout used by the native NOAA loaders, see aisdb's createtable_*.sql
+AISDB_DYNAMIC_COLUMNS = ['mmsi', 'time', 'longitude', 'latitude', 'rot', 'sog', 'cog', 'heading',
+                         'maneuver', 'utc_second', 'source']
+AISDB_STATIC_COLUMNS = ['mmsi', 'time', 'vessel_name', 'ship_type', 'call_sign', 'imo', 'dim_bow',
+                        'dim_stern', 'dim_port', 'dim_star', 'draught', 'source']
+
+AISDB_DYNAMIC_DDL = """CREATE TABLE IF NOT EXISTS ais_{month}_dynamic (
+    mmsi INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    longitude REAL NOT NULL,
+    latitude REAL NOT NULL,
+    rot REAL,
+    sog REAL,
+    cog REAL,
+    heading REAL,
+    maneuver TEXT,
+    utc_second SMALLINT,
+    source TEXT NOT NULL,
+    PRIMARY KEY (mmsi, time, longitude, latitude, source)
+){suffix}"""
+
+AISDB_STATIC_DDL = """CREATE TABLE IF NOT EXISTS ais_{month}_static (
+    mmsi INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    vessel_name TEXT,
+    ship_type INTEGER,
+    call_sign TEXT,
+    imo INTEGER NOT NULL,
+    dim_bow INTEGER,
+    dim_stern INTEGER,
+    dim_port INTEGER,
+    dim_star INTEGER,
+    draught REAL,
+    destination TEXT,
+    ais_version TEXT,
+    fixing_device TEXT,
+    eta_month INTEGER,
+    eta_day INTEGER,
+    eta_hour INTEGER,
+    eta_minute INTEGER,
+    source TEXT NOT NULL,
+    PRIMARY KEY (mmsi, time, imo, source)
+){suffix}"""
+
+# PostgreSQL binary COPY types of the staging tables, in column order (month routes rows to tables)
+STAGING_DYNAMIC_TYPES = ['int4', 'int4', 'int4', 'float4', 'float4', 'float4', 'float4', 'float4',
+                         'float4', 'text', 'int2', 'text']
+STAGING_STATIC_TYPES = ['int4', 'int4', 'int4', 'text', 'int4', 'text', 'int4', 'int4', 'int4',
+                        'int4', 'int4', 'float4', 'text']
+
+
+def read_noaa_batches(file_path: str, batch_size: int = 500000) -> Iterator[pd.DataFrame]:
+    """Stream a NOAA CSV file as DataFrame chunks, skipping malformed lines."""
+    return pd.read_csv(file_path, chunksize=batch_size, on_bad_lines='skip', encoding_errors='replace',
+                       dtype={'VesselName': str, 'IMO': str, 'CallSign': str, 'Cargo': str,
+                              'TransceiverClass': str})
+
+
+def parse_noaa_time(values: pd.Series) -> pd.Series:
+    """Parse BaseDateTime strings to epoch seconds (float, NaN where unparsable)."""
+    t = pd.to_datetime(values, format='%Y-%m-%dT%H:%M:%S', errors='coerce')
+    missing = t.isna() & values.notna()
+    if missing.any():
+        # Older archives use other layouts, fall back to per-value inference for those rows only
+        t[missing] = pd.to_datetime(values[missing], errors='coerce')
+    seconds = t.astype('datetime64[s]').astype('int64').astype('float64')
+    seconds[t.isna().to_numpy()] = np.nan
+    return pd.Series(seconds, index=values.index)
+
+
+def _half_split(values: pd.Series) -> Tuple[pd.Series, pd.Series]:
+    # NOAA only publishes overall length and width; split them evenly around the antenna
+    first = np.floor(values / 2)
+    return first, values - first
+
+
+# NOAA columns repeated on every report that describe the vessel rather than its position
+STATIC_ATTRIBUTE_COLUMNS = ['VesselName', 'IMO', 'CallSign', 'VesselType', 'Length', 'Width', 'Draft']
+_STATIC_TEXT_COLUMNS = ('VesselName', 'IMO', 'CallSign')
+
+
+class StaticChangeTracker:
+    """
+    Remembers the vessel attributes last emitted for each MMSI, so a static row is emitted only
+    when a vessel first reports attributes or when they change, instead of once per report.
+    Reports without any attribute are never emitted. One tracker is used per input file, across
+    all of its chunks.
+    """
+
+    def __init__(self):
+        self.last = {}
+
+    @staticmethod
+    def _digest(attributes: pd.DataFrame) -> np.ndarray:
+        # Normalise dtypes first: a chunk may read Length as int and the next as float
+        normalised = pd.DataFrame({
+            col: attributes[col].astype(object) if col in _STATIC_TEXT_COLUMNS
+            else pd.to_numeric(attributes[col], errors='coerce').astype('float64')
+            for col in STATIC_ATTRIBUTE_COLUMNS
+        })
+        return pd.util.hash_pandas_object(normalised, index=False).to_numpy()
+
+    def changes(self, mmsi: np.ndarray, t: np.ndarray, attributes: pd.DataFrame) -> np.ndarray:
+        """
+        Flag the rows whose attributes differ from the previous report of the same vessel, taking
+        reports in (mmsi, time) order and continuing from the attributes of earlier chunks.
+
+        Args:
+            mmsi: MMSI of each row
+            t: Sortable report time of each row
+            attributes: Frame holding STATIC_ATTRIBUTE_COLUMNS
+
+        Returns:
+            numpy.array: Boolean mask, True for rows to emit as static rows.
+        """
+        mask = np.zeros(len(mmsi), dtype=bool)
+        rows = np.flatnonzero(attributes[STATIC_ATTRIBUTE_COLUMNS].notna().any(axis=1).to_numpy())
+        if len(rows) == 0:
+            return mask
+
+        rows = rows[np.lexsort((np.asarray(t)[rows], np.asarray(mmsi)[rows]))]
+        m = np.asarray(mmsi)[rows]
+        digest = self._digest(attributes.iloc[rows])
+
+        first = np.ones(len(rows), dtype=bool)
+        first[1:] = m[1:] != m[:-1]
+        emit = first.copy()
+        emit[1:] |= digest[1:] != digest[:-1]
+        emit[first] = [self.last.get(k) != d for k, d in zip(m[first].tolist(), digest[first].tolist())]
+
+        last = np.ones(len(rows), dtype=bool)
+        last[:-1] = first[1:]
+        self.last.update(zip(m[last].tolist(), digest[last].tolist()))
+
+        mask[rows[emit]] = True
+        return mask
+
+
+def noaa_to_aisdb(chunk: pd.DataFrame, source: str = 'noaa', statics: Optional[StaticChangeTracker] = None) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Map a chunk of NOAA CSV rows onto the AISdb dynamic and static columns.
+
+    Both frames carry an extra `month` column (YYYYMM) that selects the target tables. The dynamic
+    frame holds only position and kinematics. A static row is emitted only when a vessel's
+    attributes change, as tracked by `statics` across the chunks of a file (a fresh tracker is
+    used when none is given).
+
+    Returns:
+        tuple: (dynamic DataFrame, static DataFrame)
+    """
+    t = parse_noaa_time(chunk['BaseDateTime'])
+    mmsi = pd.to_numeric(chunk['MMSI'], errors='coerce')
+    lon = pd.to_numeric(chunk['LON'], errors='coerce')
+    lat = pd.to_numeric(chunk['LAT'], errors='coerce')
+    valid = t.notna() & mmsi.notna() & lon.notna() & lat.notna()
+    chunk, t, mmsi = chunk[valid], t[valid].astype('int64'), mmsi[valid].astype('int64')
+
+    dt = pd.to_datetime(t, unit='s')
+    month = dt.dt.year * 100 + dt.dt.month
+
+    dynamic = pd.DataFrame({
+        'month': month,
+        'mmsi': mmsi,
+        'time': t,
+        'longitude': lon[valid],
+        'latitude': lat[valid],
+        'rot': np.nan,
+        'sog': pd.to_numeric(chunk['SOG'], errors='coerce'),
+        'cog': pd.to_numeric(chunk['COG'], errors='coerce'),
+        'heading': pd.to_numeric(chunk['Heading'], errors='coerce'),
+        'maneuver': None,
+        'utc_second': t % 60,
+        'source': source,
+    })
+
+    if statics is None:
+        statics = StaticChangeTracker()
+    first = statics.changes(mmsi.to_numpy(), t.to_numpy(), chunk)
+    rows = chunk[first]
+
+    length = pd.to_numeric(rows['Length'], errors='coerce')
+    width = pd.to_numeric(rows['Width'], errors='coerce')
+    dim_bow, dim_stern = _half_split(length)
+    dim_port, dim_star = _half_split(width)
+    static = pd.DataFrame({
+        'month': month[first],
+        'mmsi': mmsi[first],
+        'time': t[first],
+        'vessel_name': rows['VesselName'],
+        'ship_type': pd.to_numeric(rows['VesselType'], errors='coerce'),
+        'call_sign': rows['CallSign'],
+        'imo': pd.to_numeric(rows['IMO'].str.extract(r'(\d+)', expand=False), errors='coerce').fillna(0),
+        'dim_bow': dim_bow,
+        'dim_stern': dim_stern,
+        'dim_port': dim_port,
+        'dim_star': dim_star,
+        'draught': pd.to_numeric(rows['Draft'], errors='coerce'),
+        'source': source,
+    })
+    return dynamic, static
+
+
+def sort_for_load(frame: pd.DataFrame) -> pd.DataFrame:
+    """
+    Order a batch by (mmsi, time) with one argsort over its columns, so inserts into
+    (mmsi, time)-keyed tables fill index pages sequentially instead of in raw file order.
+    """
+    order = np.lexsort((frame['time'].to_numpy(), frame['mmsi'].to_numpy()))
+    return frame.iloc[order]
+
+
+def _records(frame: pd.DataFrame, columns: List[str], int_columns: Tuple[str, ...] = ()) -> List[tuple]:
+    """Convert frame columns to row tuples of Python values with NaN mapped to None."""
+    values = frame[columns].astype(object)
+    for col in int_columns:
+        if col in values:
+            values[col] = [None if pd.isna(v) else int(v) for v in values[col]]
+    return list(values.where(frame[columns].notna(), None).itertuples(index=False, name=None))
+
+
+_INT_COLUMNS = ('month', 'mmsi', 'time', 'utc_second', 'ship_type', 'imo', 'dim_bow', 'dim_stern', 'dim_port', 'dim_star')
+
+
+# Write-optimised settings for throwaway shard databases; a crash only loses the shard
+SQLITE_BULK_PRAGMAS = [
+    'PRAGMA journal_mode = OFF',
+    'PRAGMA synchronous = OFF',
+    'PRAGMA locking_mode = EXCLUSIVE',
+    'PRAGMA temp_store = MEMORY',
+    'PRAGMA cache_size = -1048576',
+]
+
+
+def _without_keys(ddl: str) -> str:
+    """Strip the primary key from an AISdb table definition, leaving a plain heap table."""
+    return re.sub(r',\s*PRIMARY KEY \([^)]*\)', '', ddl)
+
+
+def load_noaa_file_sqlite(dbpath: str, file_path: str, source: str = 'noaa', batch_size: int = 500000,
+                          bulk: bool = False, sort: bool = True) -> int:
+    """
+    Load one NOAA CSV file into the AISdb tables of an SQLite database.
+    Rows are inserted with executemany batches inside a single transaction per file; rows that
+    already exist are ignored, so reloading a file is harmless.
+
+    With bulk=True the database is treated as a disposable shard: write-optimised pragmas are
+    applied and the tables are created without primary keys, so no index is maintained while
+    inserting. Shards are combined into the real database with merge_sqlite_shard.
+    With sort=True each batch is inserted in (mmsi, time) order.
+
+    Returns:
+        int: Number of dynamic rows read from the file.
+    """
+    conn = sqlite3.connect(dbpath)
+    if bulk:
+        for pragma in SQLITE_BULK_PRAGMAS:
+            conn.execute(pragma)
+    statics = StaticChangeTracker()
+    created = set()
+    rows = 0
+    try:
+        for chunk in read_noaa_batches(file_path, batch_size):
+            dynamic, static = noaa_to_aisdb(chunk, source, statics)
+            if sort:
+                dynamic = sort_for_load(dynamic)
+            rows += len(dynamic)
+            for month, part in dynamic.groupby('month', sort=False):
+                if month not in created:
+                    if bulk:
+                        conn.execute(_without_keys(AISDB_DYNAMIC_DDL.format(month=month, suffix='')))
+                        conn.execute(_without_keys(AISDB_STATIC_DDL.format(month=month, suffix='')))
+                    else:
+                        conn.execute(AISDB_DYNAMIC_DDL.format(month=month, suffix=' WITHOUT ROWID'))
+                        conn.execute(AISDB_STATIC_DDL.format(month=month, suffix=' WITHOUT ROWID'))
+                    created.add(month)
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO ais_{month}_dynamic ({', '.join(AISDB_DYNAMIC_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(AISDB_DYNAMIC_COLUMNS))})",
+                    _records(part, AISDB_DYNAMIC_COLUMNS, _INT_COLUMNS))
+            for month, part in static.groupby('month'):
+                conn.executemany(
+                    f"INSERT OR IGNORE INTO ais_{month}_static ({', '.join(AISDB_STATIC_COLUMNS)}) "
+                    f"VALUES ({', '.join('?' * len(AISDB_STATIC_COLUMNS))})",
+                    _records(part, AISDB_STATIC_COLUMNS, _INT_COLUMNS))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return rows
+
+
+def merge_sqlite_shard(dbpath: str, shard_path: str) -> int:
+    """
+    Copy the AISdb tables of a shard database into dbpath with ATTACH and INSERT ... SELECT.
+    Rows are inserted ordered by (mmsi, time) so the target's primary-key B-tree is appended
+    to mostly in order; duplicates already in the target are ignored.
+
+    Returns:
+        int: Number of dynamic rows in the shard.
+    """
+    conn = sqlite3.connect(dbpath, timeout=600)
+    rows = 0
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.execute('PRAGMA cache_size = -1048576')
+        conn.execute('ATTACH DATABASE ? AS shard', (shard_path,))
+        tables = [t for (t,) in conn.execute(
+            "SELECT name FROM shard.sqlite_master WHERE type = 'table' AND name LIKE 'ais_%'")]
+        for table in sorted(tables):
+            month, kind = table.split('_')[1:3]
+            ddl, columns = (AISDB_DYNAMIC_DDL, AISDB_DYNAMIC_COLUMNS) if kind == 'dynamic' else (AISDB_STATIC_DDL, AISDB_STATIC_COLUMNS)
+            conn.execute(ddl.format(month=month, suffix=' WITHOUT ROWID'))
+            cols = ', '.join(columns)
+            conn.execute(f"INSERT OR IGNORE INTO main.{table} ({cols}) SELECT {cols} FROM shard.{table} ORDER BY mmsi, time")
+            if kind == 'dynamic':
+                rows += conn.execute(f"SELECT COUNT(*) FROM shard.{table}").fetchone()[0]
+        conn.commit()
+        conn.execute('DETACH DATABASE shard')
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        conn.close()
+    return rows
+
+
+def build_sqlite_indexes(dbpath: str):
+    """Create the secondary indexes of every AISdb month table once, then ANALYZE."""
+    conn = sqlite3.connect(dbpath, timeout=600)
+    try:
+        tables = [t for (t,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name LIKE 'ais_%_dynamic'")]
+        for table in sorted(tables):
+            print(f"Indexing {table}")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_time ON {table} (time)")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_lonlat ON {table} (longitude, latitude)")
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def create_month_tables_postgres(conn_string: str, months, dynamic: bool = True, retries: int = 3):
+    """
+    Create the AISdb tables of each YYYYMM month in their own committed transactions.
+
+    Concurrent CREATE TABLE IF NOT EXISTS statements for the same table race on the catalog, and
+    all but one fail with a unique violation. Loaders call this before their COPY transactions
+    (and ideally once per month before fanning out), and a lost race is retried, by which time the
+    table exists and the statement is a no-op.
+
+    Args:
+        conn_string: PostgreSQL connection string
+        months: YYYYMM month strings
+        dynamic: Also create the dynamic tables, not only the static ones
+        retries: Attempts per table
+    """
+    if psycopg is None:
+        raise ImportError("psycopg is required for PostgreSQL loading")
+    ddls = [AISDB_STATIC_DDL] + ([AISDB_DYNAMIC_DDL] if dynamic else [])
+    with psycopg.connect(conn_string, autocommit=True) as conn:
+        for month in months:
+            for ddl in ddls:
+                for attempt in range(retries):
+                    try:
+                        conn.execute(ddl.format(month=month, suffix=''))
+                        break
+                    except (psycopg.errors.UniqueViolation, psycopg.errors.DuplicateTable):
+                        if attempt == retries - 1:
+                            raise
+
+
+def load_noaa_file_postgres(conn_string: str, file_path: str, source: str = 'noaa', batch_size: int = 500000,
+                            binary: bool = True, sort: bool = True, month: Optional[str] = None) -> int:
+    """
+    Load one NOAA CSV file into the AISdb tables of a PostgreSQL database with COPY.
+
+    Rows are streamed with COPY (binary format by default) into temporary staging tables, then
+    moved into the monthly tables with INSERT ... ON CONFLICT DO NOTHING, all in one transaction
+    per file. The staging tables have fixed column types, so binary COPY works whatever types the
+    target tables were created with. With sort=True each batch is streamed in (mmsi, time) order.
+    Missing month tables are created by create_month_tables_postgres on a separate connection, so
+    the file transaction itself runs no DDL.
+
+    With `month` (YYYYMM) the file is loaded into the detached load partition of that month: its
+    dynamic rows go to ais_{month}_dynamic, and rows stamped in any other month go to the deferred
+    table (see flush_deferred_rows), tagged with `month`, instead of creating a plain table for that month.
+
+    Returns:
+        int: Number of dynamic rows read from the file.
+    """
+    if psycopg is None:
+        raise ImportError("psycopg is required for PostgreSQL loading")
+
+    dynamic_cols = ['month'] + AISDB_DYNAMIC_COLUMNS
+    static_cols = ['month'] + AISDB_STATIC_COLUMNS
+    fmt = ' (FORMAT BINARY)' if binary else ''
+    statics = StaticChangeTracker()
+    rows = 0
+    months = set()
+
+    with psycopg.connect(conn_string) as conn:
+        with conn.cursor() as cur:
+            cur.execute(f"CREATE TEMP TABLE staging_dynamic ({', '.join(f'{c} {t}' for c, t in zip(dynamic_cols, STAGING_DYNAMIC_TYPES))}) ON COMMIT DROP")
+            cur.execute(f"CREATE TEMP TABLE staging_static ({', '.join(f'{c} {t}' for c, t in zip(static_cols, STAGING_STATIC_TYPES))}) ON COMMIT DROP")
+
+            with cur.copy(f"COPY staging_dynamic ({', '.join(dynamic_cols)}) FROM STDIN{fmt}") as dyn_copy:
+                if binary:
+                    dyn_copy.set_types(STAGING_DYNAMIC_TYPES)
+                static_batches = []
+                for chunk in read_noaa_batches(file_path, batch_size):
+                    dynamic, static = noaa_to_aisdb(chunk, source, statics)
+                    if sort:
+                        dynamic = sort_for_load(dynamic)
+                    rows += len(dynamic)
+                    months.update(dynamic['month'].unique().tolist())
+                    for record in _records(dynamic, dynamic_cols, _INT_COLUMNS):
+                        dyn_copy.write_row(record)
+                    static_batches.append(static)
+
+            with cur.copy(f"COPY staging_static ({', '.join(static_cols)}) FROM STDIN{fmt}") as st_copy:
+                if binary:
+                    st_copy.set_types(STAGING_STATIC_TYPES)
+                for static in static_batches:
+                    for record in _records(static, static_cols, _INT_COLUMNS):
+                        st_copy.write_row(record)
+
+            create_month_tables_postgres(conn_string, sorted(months), dynamic=month is None)
+            for m in sorted(months):
+                if month is None or str(m) == month:
+                    cur.execute(f"INSERT INTO ais_{m}_dynamic ({', '.join(AISDB_DYNAMIC_COLUMNS)}) "
+                                f"SELECT {', '.join(AISDB_DYNAMIC_COLUMNS)} FROM staging_dynamic WHERE month = %s "
+                                f"ON CONFLICT DO NOTHING", (m,))
+                else:
+                    cur.execute(f"INSERT INTO {DEFERRED_DYNAMIC_TABLE} ({', '.join(AISDB_DYNAMIC_COLUMNS)}, load_month) "
+                                f"SELECT {', '.join(AISDB_DYNAMIC_COLUMNS)}, %s FROM staging_dynamic WHERE month = %s",
+                                (month, m))
+                cur.execute(f"INSERT INTO ais_{m}_static ({', '.join(AISDB_STATIC_COLUMNS)}) "
+                            f"SELECT {', '.join(AISDB_STATIC_COLUMNS)} FROM staging_static WHERE month = %s "
+                            f"ON CONFLICT DO NOTHING", (m,))
+    return rows
+
+
+def hash_file(file_path: str, block_size: int = 1 << 23) -> Tuple[str, int]:
+    """
+    Hash a file with BLAKE2b and count its data rows in the same pass.
+
+    Returns:
+        tuple: (hex digest, number of lines after the header)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    lines = 0
+    last = b''
+    with open(file_path, 'rb') as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            digest.update(block)
+            lines += block.count(b'\n')
+            last = block
+    if last and not last.endswith(b'\n'):
+        lines += 1
+    return digest.hexdigest(), max(lines - 1, 0)
+
+
+class LoadLedger:
+    """
+    Per-file load ledger kept in a table of the target database.
+
+    Each file is recorded with its hash, size, modification time, row count and status
+    ('loading', 'done' or 'failed'). Loaders ask the ledger which files are still pending, so a
+    retry or a restart after a crash only reloads files that failed, never finished or changed
+    since they were loaded. Files are only re-hashed when their size or mtime changed.
+    """
+
+    DDL = """CREATE TABLE IF NOT EXISTS noaa_load_ledger (
+    file_path TEXT PRIMARY KEY,
+    file_hash TEXT NOT NULL,
+    file_size BIGINT NOT NULL,
+    file_mtime BIGINT NOT NULL,
+    row_count BIGINT,
+    status TEXT NOT NULL,
+    error TEXT,
+    updated_at DOUBLE PRECISION NOT NULL
+)"""
+
+    def __init__(self, conn, placeholder: str = '?'):
+        self.conn = conn
+        self.ph = placeholder
+        self.conn.execute(self.DDL)
+        self._hashes: Dict[str, Tuple[str, int]] = {}
+
+    @classmethod
+    def sqlite(cls, dbpath: str) -> 'LoadLedger':
+        return cls(sqlite3.connect(dbpath, isolation_level=None, timeout=60), '?')
+
+    @classmethod
+    def postgres(cls, conn_string: str) -> 'LoadLedger':
+        if psycopg is None:
+            raise ImportError("psycopg is required for a PostgreSQL ledger")
+        return cls(psycopg.connect(conn_string, autocommit=True), '%s')
+
+    def close(self):
+        self.conn.close()
+
+    def _entry(self, file_path: str) -> Optional[tuple]:
+        return self.conn.execute(
+            f"SELECT file_hash, file_size, file_mtime, status FROM noaa_load_ledger WHERE file_path = {self.ph}",
+            (os.path.abspath(file_path),)).fetchone()
+
+    def _hash(self, file_path: str) -> Tuple[str, int]:
+        if file_path not in self._hashes:
+            self._hashes[file_path] = hash_file(file_path)
+        return self._hashes[file_path]
+
+    def pending(self, file_paths: List[str]) -> List[str]:
+        """Return the files that are not recorded as loaded with their current content."""
+        todo = []
+        for file_path in file_paths:
+            entry = self._entry(file_path)
+            if entry is None or entry[3] != 'done':
+                todo.append(file_path)
+                continue
+            path, size, mtime = file_signature(file_path)
+            if (size, mtime) == (entry[1], entry[2]):
+                continue
+            if self._hash(file_path)[0] != entry[0]:
+                todo.append(file_path)
+            else:
+                # Same content with a new mtime (e.g. copied), remember it to skip hashing next time
+                self.conn.execute(
+                    f"UPDATE noaa_load_ledger SET file_size = {self.ph}, file_mtime = {self.ph} WHERE file_path = {self.ph}",
+                    (size, mtime, path))
+        return todo
+
+    def _record(self, file_path: str, status: str, row_count: Optional[int] = None, error: Optional[str] = None):
+        path, size, mtime = file_signature(file_path)
+        file_hash, lines = self._hash(file_path)
+        ph = self.ph
+        self.conn.execute(
+            f"INSERT INTO noaa_load_ledger (file_path, file_hash, file_size, file_mtime, row_count, status, error, updated_at) "
+            f"VALUES ({ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}, {ph}) "
+            f"ON CONFLICT (file_path) DO UPDATE SET file_hash = excluded.file_hash, file_size = excluded.file_size, "
+            f"file_mtime = excluded.file_mtime, row_count = excluded.row_count, status = excluded.status, "
+            f"error = excluded.error, updated_at = excluded.updated_at",
+            (path, file_hash, size, mtime, lines if row_count is None else row_count, status, error, time.time()))
+
+    def start(self, file_path: str):
+        self._record(file_path, 'loading')
+
+    def done(self, file_path: str, row_count: Optional[int] = None):
+        self._record(file_path, 'done', row_count)
+
+    def fail(self, file_path: str, error: str):
+        self._record(file_path, 'failed', error=error)
+
+    def summary(self) -> Dict[str, int]:
+        return dict(self.conn.execute("SELECT status, COUNT(*) FROM noaa_load_ledger GROUP BY status").fetchall())
+
+
+class ScratchSpace:
+    """
+    Scratch directory owned by one run, placed on a configurable (ideally fast, local) device.
+
+    The root defaults to $NOAA_SCRATCH_DIR, then the system temp directory. Each run gets its own
+    directory below the root and each worker a subdirectory of it, so cleaning up only ever removes
+    this run's files. Usage is measured against an optional quota.
+    """
+
+    def __init__(self, root: Optional[str] = None, quota_bytes: Optional[int] = None, prefix: str = 'noaa-scratch'):
+        self.root = root or os.environ.get('NOAA_SCRATCH_DIR') or tempfile.gettempdir()
+        os.makedirs(self.root, exist_ok=True)
+        self.quota_bytes = quota_bytes
+        self.path = tempfile.mkdtemp(prefix=f'{prefix}-{os.getpid()}-', dir=self.root)
+
+    def __enter__(self) -> 'ScratchSpace':
+        return self
+
+    def __exit__(self, *exc):
+        self.cleanup()
+
+    def worker_dir(self, name: str) -> str:
+        """Create (if needed) and return the subdirectory for one worker or task."""
+        path = os.path.join(self.path, name)
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def bytes_used(self) -> int:
+        total = 0
+        for dirpath, _, filenames in os.walk(self.path):
+            for name in filenames:
+                try:
+                    total += os.lstat(os.path.join(dirpath, name)).st_size
+                except FileNotFoundError:
+                    pass  # removed by a worker while walking
+        return total
+
+    def over_quota(self) -> bool:
+        return self.quota_bytes is not None and self.bytes_used() > self.quota_bytes
+
+    def reset(self, name: Optional[str] = None):
+        """Empty this run's directory, or only the named worker directory, keeping the directory itself."""
+        target = self.path if name is None else os.path.join(self.path, name)
+        if not os.path.isdir(target):
+            return
+        for entry in os.listdir(target):
+            path = os.path.join(target, entry)
+            if os.path.isdir(path) and not os.path.islink(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                os.remove(path)
+        print(f"Cleared scratch directory: {target}")
+
+    def cleanup(self):
+        shutil.rmtree(self.path, ignore_errors=True)
+
+
+@contextmanager
+def use_tempdir(path: str):
+    """Point tempfile and $TMPDIR at path, so temp files of libraries and child processes land there."""
+    old_tempdir, old_env = tempfile.tempdir, os.environ.get('TMPDIR')
+    tempfile.tempdir = path
+    os.environ['TMPDIR'] = path
+    try:
+        yield path
+    finally:
+        tempfile.tempdir = old_tempdir
+        if old_env is None:
+            os.environ.pop('TMPDIR', None)
+        else:
+            os.environ['TMPDIR'] = old_env
+
+
+def build_sqlite_rtree(dbpath: str, bucket_seconds: int = 3600, rebuild: bool = False):
+    """
+    Build an R*Tree spatial-temporal index and a covering (mmsi, time) index for each AISdb month.
+
+    The R*Tree holds one box per vessel and time bucket (lon, lat and time extents of that
+    vessel's reports in the bucket) rather than one entry per report, which keeps it small.
+    Queries find candidate boxes in the R*Tree and read the matching rows through the covering
+    index with a range scan per box; see query_sqlite_tracks.
+    """
+    conn = sqlite3.connect(dbpath, timeout=600)
+    try:
+        tables = [t for (t,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table' AND name GLOB 'ais_[0-9]*_dynamic'")]
+        for table in sorted(tables):
+            rtree = f"{table}_rtree"
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone()
+            if exists and not rebuild:
+                print(f"R*Tree {rtree} already exists, skipping")
+                continue
+            start_time = time.time()
+            conn.execute(f"DROP TABLE IF EXISTS {rtree}")
+            # +columns are auxiliary values stored exactly, the box coordinates are 32-bit floats
+            conn.execute(f"CREATE VIRTUAL TABLE {rtree} USING rtree("
+                         f"id, min_lon, max_lon, min_lat, max_lat, min_time, max_time, +mmsi, +t_start, +t_end)")
+            conn.execute(f"INSERT INTO {rtree} (min_lon, max_lon, min_lat, max_lat, min_time, max_time, mmsi, t_start, t_end) "
+                         f"SELECT MIN(longitude), MAX(longitude), MIN(latitude), MAX(latitude), MIN(time), MAX(time), "
+                         f"mmsi, (time / {bucket_seconds}) * {bucket_seconds}, (time / {bucket_seconds} + 1) * {bucket_seconds} "
+                         f"FROM {table} GROUP BY mmsi, time / {bucket_seconds}")
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_mmsi_time ON {table} "
+                         f"(mmsi, time, longitude, latitude, sog, cog, heading)")
+            conn.commit()
+            boxes = conn.execute(f"SELECT COUNT(*) FROM {rtree}").fetchone()[0]
+            print(f"Built {rtree}: {boxes} boxes in {time.time() - start_time:.2f} seconds")
+        conn.execute('ANALYZE')
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def query_sqlite_tracks(dbpath: str, bbox: Tuple[float, float, float, float], start: int, end: int) -> List[tuple]:
+    """
+    Fetch dynamic reports inside a bounding box and time range using the R*Tree indexes.
+
+    Args:
+        dbpath: SQLite database built by the loaders and indexed with build_sqlite_rtree
+        bbox: Bounding box as (min_lon, min_lat, max_lon, max_lat)
+        start: Start of the time range, epoch seconds (inclusive)
+        end: End of the time range, epoch seconds (inclusive)
+
+    Returns:
+        list: (mmsi, time, longitude, latitude, sog, cog, heading) tuples ordered by mmsi and time
+    """
+    min_lon, min_lat, max_lon, max_lat = bbox
+    first, last = pd.Timestamp(start, unit='s'), pd.Timestamp(end, unit='s')
+    months = [f"{p.year}{p.month:02d}" for p in pd.period_range(first, last, freq='M')]
+
+    conn = sqlite3.connect(dbpath)
+    rows = []
+    try:
+        for month in months:
+            table, rtree = f"ais_{month}_dynamic", f"ais_{month}_dynamic_rtree"
+            if not conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone():
+                if conn.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (table,)).fetchone():
+                    print(f"Warning: {table} has no R*Tree index, run build_sqlite_rtree first")
+                continue
+            rows += conn.execute(
+                f"SELECT d.mmsi, d.time, d.longitude, d.latitude, d.sog, d.cog, d.heading "
+                f"FROM {rtree} r JOIN {table} d ON d.mmsi = r.mmsi AND d.time >= r.t_start AND d.time < r.t_end "
+                f"WHERE r.max_lon >= :min_lon AND r.min_lon <= :max_lon "
+                f"AND r.max_lat >= :min_lat AND r.min_lat <= :max_lat "
+                f"AND r.max_time >= :start AND r.min_time <= :end "
+                f"AND d.longitude BETWEEN :min_lon AND :max_lon AND d.latitude BETWEEN :min_lat AND :max_lat "
+                f"AND d.time BETWEEN :start AND :end "
+                f"ORDER BY d.mmsi, d.time",
+                {'min_lon': min_lon, 'max_lon': max_lon, 'min_lat': min_lat, 'max_lat': max_lat,
+                 'start': start, 'end': end}).fetchall()
+    finally:
+        conn.close()
+    return rows
+
+
+# Plain PostgreSQL: monthly partitions of a range-partitioned ais_dynamic parent, loaded while detached
+PARTITION_PARENT_DDL = """CREATE TABLE IF NOT EXISTS ais_dynamic (
+    mmsi INTEGER NOT NULL,
+    time INTEGER NOT NULL,
+    longitude REAL NOT NULL,
+    latitude REAL NOT NULL,
+    rot REAL,
+    sog REAL,
+    cog REAL,
+    heading REAL,
+    maneuver TEXT,
+    utc_second SMALLINT,
+    source TEXT NOT NULL
+) PARTITION BY RANGE (time)"""
+
+# Rows read while loading a partition but stamped in another month wait here until that month is attached
+DEFERRED_DYNAMIC_TABLE = 'ais_dynamic_deferred'
+
+# name suffix -> column list, created on the parent and built on each partition before attaching
+PARTITION_INDEXES = {
+    'mmsi_time': '(mmsi, time)',
+    'time': '(time)',
+    'lonlat': '(longitude, latitude)',
+}
+
+
+def month_bounds(month: str) -> Tuple[int, int]:
+    """Epoch-second range [start, end) of a YYYYMM month."""
+    start = pd.Timestamp(year=int(month[:4]), month=int(month[4:]), day=1)
+    return int(start.timestamp()), int((start + pd.offsets.MonthBegin(1)).timestamp())
+
+
+def partition_attached(conn, month: str) -> bool:
+    """True if ais_{month}_dynamic is already a partition of ais_dynamic (False if there is no parent yet)."""
+    return conn.execute(
+        "SELECT 1 FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = to_regclass('ais_dynamic') AND c.relname = %s",
+        (f"ais_{month}_dynamic",)).fetchone() is not None
+
+
+def create_partition_parent(conn):
+    """
+    Create the partitioned ais_dynamic parent, its indexes and the deferred table. Concurrent
+    IF NOT EXISTS statements race on the catalog, so this runs once before months load in parallel.
+    Deferred rows carry the load_month that wrote them, so a failed month can discard its own rows.
+    """
+    conn.execute(PARTITION_PARENT_DDL)
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {DEFERRED_DYNAMIC_TABLE} "
+                 f"(LIKE ais_dynamic INCLUDING DEFAULTS, load_month TEXT NOT NULL)")
+    for suffix, columns in PARTITION_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_ais_dynamic_{suffix} ON ais_dynamic {columns}")
+
+
+def create_load_partition(conn, month: str):
+    """
+    Create a fresh standalone table for the month that is unlogged and has no indexes or keys,
+    ready for bulk loading. A stale table and deferred rows left by a failed load are dropped first.
+    The parent must already exist (see create_partition_parent).
+    """
+    table = f"ais_{month}_dynamic"
+    existing = conn.execute("SELECT relpersistence FROM pg_class WHERE relname = %s AND relkind = 'r'", (table,)).fetchone()
+    if existing is not None:
+        if existing[0] != 'u' or partition_attached(conn, month):
+            raise ValueError(f"{table} already exists and is not a pending load partition")
+        conn.execute(f"DROP TABLE {table}")
+    conn.execute(f"DELETE FROM {DEFERRED_DYNAMIC_TABLE} WHERE load_month = %s", (month,))
+    conn.execute(f"CREATE UNLOGGED TABLE {table} (LIKE ais_dynamic INCLUDING DEFAULTS)")
+
+
+def attach_load_partition(conn, month: str):
+    """
+    Finish a loaded month: build its indexes, ANALYZE, make it logged and attach it to ais_dynamic.
+    A CHECK constraint matching the partition bounds lets ATTACH skip its validation scan, and the
+    prebuilt indexes are adopted by the parent's partitioned indexes instead of being rebuilt.
+    """
+    table = f"ais_{month}_dynamic"
+    start, end = month_bounds(month)
+    for suffix, columns in PARTITION_INDEXES.items():
+        conn.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{suffix} ON {table} {columns}")
+    conn.execute(f"ANALYZE {table}")
+    conn.execute(f"ALTER TABLE {table} SET LOGGED")
+    conn.execute(f"ALTER TABLE {table} ADD CONSTRAINT {table}_bounds CHECK (time >= {start} AND time < {end})")
+    conn.execute(f"ALTER TABLE ais_dynamic ATTACH PARTITION {table} FOR VALUES FROM ({start}) TO ({end})")
+    conn.execute(f"ALTER TABLE {table} DROP CONSTRAINT {table}_bounds")
+
+
+def flush_deferred_rows(conn) -> int:
+    """
+    Move deferred rows into ais_dynamic for every month whose partition is attached, one
+    transaction per month. Rows of months not loaded yet stay deferred.
+
+    Returns:
+        int: Number of rows moved.
+    """
+    months = conn.execute(
+        f"SELECT DISTINCT to_char(to_timestamp(time) AT TIME ZONE 'UTC', 'YYYYMM') "
+        f"FROM {DEFERRED_DYNAMIC_TABLE}").fetchall()
+    moved = 0
+    for (month,) in months:
+        if not partition_attached(conn, month):
+            continue
+        start, end = month_bounds(month)
+        with conn.transaction():
+            moved += conn.execute(f"INSERT INTO ais_dynamic ({', '.join(AISDB_DYNAMIC_COLUMNS)}) "
+                                  f"SELECT {', '.join(AISDB_DYNAMIC_COLUMNS)} FROM {DEFERRED_DYNAMIC_TABLE} "
+                                  f"WHERE time >= %s AND time < %s", (start, end)).rowcount
+            conn.execute(f"DELETE FROM {DEFERRED_DYNAMIC_TABLE} WHERE time >= %s AND time < %s", (start, end))
+    return moved
+
+
+def drop_load_partition(conn, month: str):
+    """
+    Discard a month whose load failed, with the rows it deferred to other months; it was never
+    attached, so the parent is untouched.
+    """
+    if not partition_attached(conn, month):
+        conn.execute(f"DROP TABLE IF EXISTS ais_{month}_dynamic")
+        conn.execute(f"DELETE FROM {DEFERRED_DYNAMIC_TABLE} WHERE load_month = %s", (month,))